@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+    tenxtools.bgzf
+    ~~~~~~~~~~~~~~
+
+    block gzip (BGZF) writer and reader, blocks are (de)compressed in a
+    thread pool
+
+    @Copyright: (c) 2026-10 by the bioutensil contributors.
+    @License: LICENSE_NAME, see LICENSE for more details.
+"""
+import io
+import gzip
+import zlib
+import codecs
+import queue
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 0xff00    # max uncompressed bytes per block, same as htslib
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def compress_block(data, level=6):
+    # zlib releases the GIL, so blocks compress in parallel threads
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255,
+                         6, 66, 67, 2, len(cdata) + 25)
+    footer = struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + footer
+
+
+def tabix_index(fn, **kwargs):
+    import pysam
+    return pysam.tabix_index(fn, force=True, **kwargs)
+
+
+class BgzfWriter(object):
+    """File like BGZF writer, output is bgzip and tabix compatible.
+
+    Accepts str or bytes. tabix_index is a dict of pysam.tabix_index
+    arguments, e.g. {'preset': 'bed'}, and builds the index on close.
+    Threads start on the first full block, so a short write is compressed
+    in the calling thread, and appending replaces the EOF block at the end
+    of the file, so repeated appends leave a single one.
+    """
+
+    def __init__(self, fn, mode='wb', threads=4, level=6,
+                 tabix_index=None):
+        self.fn = fn
+        self.level = level
+        self.tabix_index = tabix_index
+        mode = mode.replace('t', '').replace('b', '')
+        if mode == 'a':
+            _strip_eof_block(fn)
+        self._raw = open(fn, mode + 'b')
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._threads = threads
+        self._max_pending = threads * 4
+        self._executor = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self._buffer += data
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, block):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self._threads)
+        self._pending.append(self._executor.submit(compress_block, block, self.level))
+        while len(self._pending) > self._max_pending:
+            self._raw.write(self._pending.popleft().result())
+
+    def flush(self):
+        if self._buffer and self._executor is None:
+            self._raw.write(compress_block(bytes(self._buffer), self.level))
+            self._buffer = bytearray()
+        elif self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._raw.write(self._pending.popleft().result())
+        self._raw.flush()
+
+    @property
+    def closed(self):
+        return self._raw.closed
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            self._raw.write(EOF_BLOCK)
+        finally:
+            self._raw.close()
+            if self._executor is not None:
+                self._executor.shutdown()
+        if self.tabix_index is not None:
+            tabix_index(self.fn, **self.tabix_index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _strip_eof_block(fn):
+    # drop the empty EOF block ending a BGZF file before appending to it
+    try:
+        f = open(fn, 'r+b')
+    except FileNotFoundError:
+        return
+    with f:
+        size = f.seek(0, io.SEEK_END)
+        if size < len(EOF_BLOCK):
+            return
+        f.seek(size - len(EOF_BLOCK))
+        if f.read() == EOF_BLOCK:
+            f.truncate(size - len(EOF_BLOCK))
+
+
+# --- reading --- #
+def is_bgzf(fn):
+    with open(fn, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' \
+        and header[12:14] == b'BC'
+
+
+def _read_blocks(f):  # raw deflate data, crc and isize of each block
+    while True:
+        header = f.read(12)
+        if not header:
+            return
+        if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+            raise ValueError('Invalid BGZF block header in {}'.format(f.name))
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = f.read(xlen)
+        block_size = None
+        i = 0
+        while i + 4 <= xlen:
+            slen = struct.unpack('<H', extra[i+2:i+4])[0]
+            if extra[i:i+2] == b'BC':
+                block_size = struct.unpack('<H', extra[i+4:i+6])[0] + 1
+            i += 4 + slen
+        if block_size is None:
+            raise ValueError('Missing BGZF block size in {}'.format(f.name))
+        yield f.read(block_size - 12 - xlen)
+
+
+def decompress_block(block):
+    data = zlib.decompress(block[:-8], -15)
+    crc, size = struct.unpack('<2I', block[-8:])
+    if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+        raise ValueError('Corrupted BGZF block')
+    return data
+
+
+def _bgzf_chunks(fn, threads, read_ahead):
+    executor = ThreadPoolExecutor(threads)
+    pending = deque()
+    try:
+        with open(fn, 'rb') as f:
+            for block in _read_blocks(f):
+                pending.append(executor.submit(decompress_block, block))
+                if len(pending) >= read_ahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def _gzip_chunks(fn, chunk_size=1024*1024):  # plain, maybe multi member, gzip
+    decompressor = zlib.decompressobj(31)
+    with open(fn, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            while data:
+                out = decompressor.decompress(data)
+                if out:
+                    yield out
+                data = b''
+                if decompressor.eof:
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(31)
+
+
+def _background(chunks, read_ahead):
+    # run the chunks generator in a thread, at most read_ahead chunks ahead
+    q = queue.Queue(read_ahead)
+    stop = threading.Event()
+    done = object()
+
+    def put(x):
+        while not stop.is_set():
+            try:
+                q.put(x, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def run():
+        try:
+            for chunk in chunks:
+                put(chunk)
+                if stop.is_set():
+                    return
+        except Exception as e:
+            put(e)
+        put(done)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = q.get()
+            if chunk is done:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+
+
+def iter_lines(fn, threads=0, read_ahead=16):
+    """Text lines of a plain, gzip or BGZF file.
+
+    With threads, BGZF blocks are decompressed in a thread pool, at most
+    read_ahead blocks ahead of the caller, and plain gzip is decompressed
+    in one background thread so it still overlaps with parsing.
+    """
+    if not threads or not fn.endswith('gz'):
+        opener = gzip.open if fn.endswith('gz') else open
+        with opener(fn, 'rt') as f:
+            for line in f:
+                yield line
+        return
+
+    if is_bgzf(fn):
+        chunks = _bgzf_chunks(fn, threads, read_ahead)
+    else:
+        chunks = _background(_gzip_chunks(fn), read_ahead)
+
+    # universal newlines as the text mode open above
+    decoder = io.IncrementalNewlineDecoder(
+        codecs.getincrementaldecoder('utf-8')(), translate=True)
+    rest = ''
+    try:
+        for chunk in chunks:
+            lines = (rest + decoder.decode(chunk)).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line + '\n'
+    finally:
+        chunks.close()  # stops the threads when the caller stops early
+    # a pending '\r' ends the last line, nothing else splits it
+    rest += decoder.decode(b'', final=True)
+    if rest:
+        yield rest
@@ -9,12 +9,16 @@
     @License: LICENSE_NAME, see LICENSE for more details.
 """
 
-from tenxtools.utils import io
+from tenxtools.utils import myio
 
 
-class CNVRecord(io.Record):
+class CNVRecord(myio.Record):
 
     fields = 'id,chr,start,end,np,mean,arm,snvs,ai,median,Cn,mCn,fullCN,meanCn,purity'.split(',')  # tumor_percent
+    converters = {'id': int, 'chr': None, 'start': int, 'end': int,
+                  'np': int, 'mean': float, 'arm': None, 'snvs': int,
+                  'ai': float, 'median': float, 'Cn': int, 'mCn': int,
+                  'fullCN': None, 'meanCn': float, 'purity': float}
 
     def __init__(self, *args, **kwargs):
         super(CNVRecord, self).__init__(*args, **kwargs)
@@ -61,16 +65,16 @@ class CNVRecord(io.Record):
         return ','.join(str(getattr(self, field)) for field in self.fields)
 
 
-class CNVReader(io.Reader):
+class CNVReader(myio.Reader):
 
     def __init__(self, fn, cnv_cls=CNVRecord, sep=',', has_header=True):
-        super(CNVReader, self).__init__(fn, record_cls=cnv_cls, sep=sep, has_header=has_header)
+        super(CNVReader, self).__init__(in_fn=fn, record_cls=cnv_cls, sep=sep, has_header=has_header)
 
 
-class CNVWriter(io.Writer):
+class CNVWriter(myio.Writer):
 
-    def __init__(self, fn, cnv_cls=CNVRecord, sep=','):
-        super(CNVWriter, self).__init__(fn, record_cls=cnv_cls, sep=sep)
+    def __init__(self, fn, cnv_cls=CNVRecord, sep=',', **kwargs):
+        super(CNVWriter, self).__init__(fn, record_cls=cnv_cls, sep=sep, **kwargs)
 
 '''
 if __name__ == "__main__":
@@ -1,6 +1,11 @@
+import os
 import csv
 import gzip
+import pickle
 import sys
+import tempfile
+
+from tenxtools.utils import bgzf
 
 csv.field_size_limit(sys.maxsize)
 
@@ -20,6 +25,9 @@ def str2list(sep=','):
         return [] if x == '.' else x.split(sep)
     return func
 
+def identity(x):
+    return x
+
 # --- dump mapping function --- #
 list2str = lambda l: ','.join([ str(x) for x in l]) if l else '.'
 
@@ -42,22 +50,78 @@ def assign_reduce_map(func_init2headers):
         for h in headers: _map[(h,init)] = func
     return _map
 
+# --- streaming reducers --- #
+class Reducer(object):
+    """Fold one column of a group row by row, acc = func(acc, value)."""
+
+    def __init__(self, func, init=None):
+        self.func = func
+        self.init = init
+
+    def start(self):
+        return self.init
+
+    def update(self, acc, value):
+        return self.func(acc, value)
+
+class ListReducer(Reducer):
+    """Collect one column of a group, appended in place unlike list_append."""
+
+    def __init__(self):
+        Reducer.__init__(self, list_append, 'empty_list')
+
+    def start(self):
+        return []
+
+    def update(self, acc, value):
+        acc.append(value)
+        return acc
+
+def make_reducers(reduce_map):
+    # reduce_map as from assign_reduce_map, {(header, init): func}
+    reducers = {}
+    for (header, init), func in reduce_map.items():
+        reducers[header] = ListReducer() if func is list_append else Reducer(func, init)
+    return reducers
+
+def _dump_part(rows, header, n_parts, salt, tmp_dir):
+    # hash partition rows to temp files, salt differs per level
+    fns, fs = [], []
+    for _ in range(n_parts):
+        fd, fn = tempfile.mkstemp(suffix='.part', dir=tmp_dir)
+        fns.append(fn)
+        fs.append(os.fdopen(fd, 'wb'))
+    try:
+        for row in rows:
+            pickle.dump(row, fs[hash((salt, row[header])) % n_parts], pickle.HIGHEST_PROTOCOL)
+    finally:
+        for f in fs: f.close()
+    return fns
+
+def _load_part(fn):
+    with open(fn, 'rb') as f:
+        while True:
+            try: yield pickle.load(f)
+            except EOFError: return
+
 
 class csvReader(object):
 
-    def __init__(self, in_fn, load_map, headers=None, sep=',', reduce_map={}, has_header=False):
+    def __init__(self, in_fn, load_map, headers=None, sep=',', reduce_map={}, has_header=False, threads=0):
         self.in_fn = in_fn
         self.load_map = load_map
         self.headers = headers
         self.sep = sep
         self.reduce_map = reduce_map
         self.has_header = has_header
+        self.threads = threads  # > 0, decompress .gz input ahead of parsing
 
     def _load_row(self, row, filtered_funcs=[], required_headers='all'):
         error = []
+        load_map = self.load_map
         for header, filtered_func in filtered_funcs:
             if header in row:
-                value = self.load_map.get(header, lambda x:x)(row[header])
+                value = load_map.get(header, identity)(row[header])
                 if not filtered_func(value):
                     error.append('%s=%s' % (header, str(value)))
         if error:
@@ -68,18 +132,75 @@ class csvReader(object):
 
         data = {}
         for header in required_headers:
-            value = row[header]
-            value = self.load_map.get(header, lambda x: x)(value)
-            data[header] = value
+            data[header] = load_map.get(header, identity)(row[header])
         return data
 
-    def read_rows(self, filtered_funcs=[], required_headers='all'):
+    def compile_row_loader(self, headers, filtered_funcs=[], required_headers='all'):
+        """Compile _load_row for rows split into a list of fields by headers.
 
-        if self.in_fn.endswith('.gz'):
-            f = gzip.open(self.in_fn, 'rb')
-        else:
-            f = open(self.in_fn, 'rb')
+        Returns (last, load), load(fields) gives the row dict, or None if a
+        filter rejects it, and only looks at fields up to index last.
+        """
+        index = dict((header, j) for j, header in enumerate(headers))
+        load_map = self.load_map
+        filters = [(index[header], load_map.get(header, identity), filtered_func)
+                   for header, filtered_func in filtered_funcs if header in index]
+
+        if required_headers == 'all': required_headers = self.headers
+        if not required_headers: required_headers = headers
+        project = [(header, index[header], load_map.get(header, identity))
+                   for header in required_headers]
+        last = max([j for j, _, _ in filters] + [j for _, j, _ in project] + [0])
+
+        def load(fields):
+            for j, func, filtered_func in filters:
+                if not filtered_func(func(fields[j])): return None
+            return {header: func(fields[j]) for header, j, func in project}
+
+        return last, load
+
+    def _split_line(self, line, maxsplit=-1):
+        # plain lines are split by str.split, quotes or spaces to skip go to csv
+        sep = self.sep
+        if '"' in line or sep + ' ' in line or line[:1] == ' ':
+            return next(csv.reader([line], delimiter=sep, skipinitialspace=True))
+        return line.split(sep, maxsplit)
+
+    def read_projected(self, filtered_funcs=[], required_headers='all'):
+        """read_rows, but splits only up to the last needed column, converts
+        only the required headers and rejects rows before building dicts.
+
+        Yields the same (i, row) as read_rows, quoted fields can not span lines.
+        """
+        lines = bgzf.iter_lines(self.in_fn, threads=self.threads)
+        headers = self.headers
+        if headers is None:  # as csv.DictReader, the first line names the fields
+            for line in lines:
+                line = line.rstrip('\r\n')
+                if line:
+                    headers = self._split_line(line)
+                    break
+            else:
+                return
+        last, load = self.compile_row_loader(headers, filtered_funcs, required_headers)
+        n = last + 1
+        padding = [None] * n  # as DictReader restval for short rows
+
+        i = -1
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if not line: continue  # DictReader skips blank lines uncounted
+            i += 1
+            if i == 0 and self.has_header: continue
+            fields = self._split_line(line, n)
+            if len(fields) < n: fields = fields + padding[len(fields):]
+            row = load(fields)
+            if row is not None:
+                yield (i - 1 if self.has_header else i, row)
 
+    def read_rows(self, filtered_funcs=[], required_headers='all'):
+
+        f = bgzf.iter_lines(self.in_fn, threads=self.threads)
         collection = csv.DictReader(f, fieldnames=self.headers, delimiter=self.sep, skipinitialspace=True)
         for i, row in enumerate(collection):
             if i == 0 and self.has_header: pass
@@ -90,6 +211,11 @@ class csvReader(object):
                     yield (i, row)
 
     def read_chunks(self, header, filtered_funcs=[], required_headers='all', reduce=False):
+        if reduce:  # fold as rows arrive instead of keeping each group
+            for value, res in self.aggregate(header, None, filtered_funcs, required_headers):
+                yield (value, [res])
+            return
+
         chunks = []
         prev_value = None
         chunk_i = 0
@@ -108,70 +234,182 @@ class csvReader(object):
     def reduce_chunks(self, chunks, reduce):
         if not reduce: return chunks
 
-        reduce_map = {  head_init:func for head_init, func in self.reduce_map.items() if head_init[0] in chunks[0].keys()}
-
-        res = { header:init for header, init in reduce_map.keys() }
-        for row in chunks:
-            for header_init, func in reduce_map.items():
-                header, _ = header_init
-                res[header] = func(res[header], row[header])
+        res = {}
+        for header, reducer in make_reducers(self.reduce_map).items():
+            if header not in chunks[0]: continue
+            acc = reducer.start()
+            for row in chunks:
+                acc = reducer.update(acc, row[header])
+            res[header] = acc
 
         return [res]
 
+    def aggregate(self, header, reducers=None, filtered_funcs=[], required_headers='all',
+                  sorted_input=True, max_groups=1000000, n_parts=16, tmp_dir=None):
+        """Group rows by header and fold the groups as rows arrive.
+
+        Yields (value, {header: result}), reducers maps headers to Reducer and
+        defaults to reduce_map. Sorted input keeps one group in memory, else
+        groups are hashed in input order until there are max_groups of them,
+        then the input is partitioned to temp files and each part is folded
+        in turn, so groups come out in no particular order.
+        """
+        if reducers is None: reducers = make_reducers(self.reduce_map)
+        read = lambda: (row for _, row in self.read_rows(filtered_funcs, required_headers))
+        if sorted_input:
+            return self._aggregate_sorted(read(), header, reducers)
+        return self._aggregate_hash(read, header, reducers, max_groups, n_parts, tmp_dir)
+
+    def _active(self, row, reducers):
+        return [(h, r) for h, r in reducers.items() if h in row]
+
+    def _aggregate_sorted(self, rows, header, reducers):
+        active, key, acc = None, None, None
+        for row in rows:
+            if active is None:
+                active = self._active(row, reducers)
+            value = row[header]
+            if acc is None or value != key:
+                if acc is not None:
+                    yield (key, {h: a for (h, _), a in zip(active, acc)})
+                key, acc = value, [r.start() for _, r in active]
+            for j, (h, r) in enumerate(active):
+                acc[j] = r.update(acc[j], row[h])
+
+        if acc is not None: yield (key, {h: a for (h, _), a in zip(active, acc)})
+
+    def _aggregate_hash(self, read, header, reducers, max_groups, n_parts, tmp_dir, level=0):
+        # read() returns a fresh iterator over the rows, it is read again on spill
+        active, groups = None, {}
+        for row in read():
+            if active is None:
+                active = self._active(row, reducers)
+            value = row[header]
+            acc = groups.get(value)
+            if acc is None:
+                if len(groups) >= max_groups and level < 8: break
+                acc = groups[value] = [r.start() for _, r in active]
+            for j, (h, r) in enumerate(active):
+                acc[j] = r.update(acc[j], row[h])
+        else:
+            for key, acc in groups.items():
+                yield (key, {h: a for (h, _), a in zip(active, acc)})
+            return
+
+        groups = None
+        fns = _dump_part(read(), header, n_parts, level, tmp_dir)
+        try:
+            for fn in fns:
+                part = lambda fn=fn: _load_part(fn)
+                for res in self._aggregate_hash(part, header, reducers, max_groups, n_parts, tmp_dir, level + 1):
+                    yield res
+                os.remove(fn)
+        finally:
+            for fn in fns:
+                if os.path.exists(fn): os.remove(fn)
+
 class csvWriter():
+    """Write rows as sep separated lines under a header line.
+
+    tabix_index is a dict of pysam.tabix_index arguments, e.g.
+    {'preset': 'bed'} for a tab separated, threads > 0 BGZF .gz output.
+    The header line is then prefixed by its meta_char, '#' by default,
+    so tabix skips it, and the index is built on close once written.
+    """
 
-    def __init__(self, out_fn, dump_map, headers, sep=','):
+    def __init__(self, out_fn, dump_map, headers, sep=',', threads=0, tabix_index=None,
+                 buffer_size=1024*1024):
         self.out_fn = out_fn
         self.dump_map = dump_map
         self.headers = headers
         self.sep = sep
+        self.threads = threads  # > 0, write .gz as BGZF compressed in threads
+        self.tabix_index = tabix_index  # pysam.tabix_index kwargs, see close
+        self.buffer_size = buffer_size  # chars buffered in a with block
+        self._stale = False  # written since the last index
+
+        # dump_map compiled to one formatter per column
+        self.formatters = [dump_map.get(header, str) for header in headers]
+        self._handle = None
+        self._lines = []
+        self._buffered = 0
 
         self._write_header()
 
-    def _write_header(self):
+    def _open(self, mod):
         if self.out_fn.endswith('.gz'):
-            f = gzip.open(self.out_fn, 'wb')
-        else:
-            f = open(self.out_fn, 'wb')
+            if self.threads:
+                return bgzf.BgzfWriter(self.out_fn, mod, threads=self.threads)
+            return gzip.open(self.out_fn, mod)
+        return open(self.out_fn, mod)
+
+    def open(self):
+        # keep one handle and write buffered lines in large blocks until close
+        if self._handle is None:
+            self._handle = self._open('ab')
+        return self
+
+    def flush(self):
+        if self._lines and self._handle is not None:
+            self._handle.write(''.join(self._lines).encode())
+            self._lines = []
+            self._buffered = 0
+
+    def close(self, final=True):
+        if self._handle is not None:
+            self.flush()
+            self._handle.close()
+            self._handle = None
+        if final and self._stale and self.tabix_index is not None:
+            bgzf.tabix_index(self.out_fn, **self.tabix_index)
+            self._stale = False
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_header(self):
+        f = self._open('wb')
 
         line = self.sep.join(self.headers) + '\n'
-        f.write(line)
+        if self.tabix_index is not None:
+            line = self.tabix_index.get('meta_char', '#') + line
+        f.write(line.encode())
+        f.close()
+        self._stale = True
         return True
 
-    def _dump_row(self, row):
-        data = {}
-        for header, value in row.items():
-            value = self.dump_map.get(header, str)(value)
-            data[header] = value
-        return data
+    def _format_rows(self, rows):
+        # dicts by headers, tuples and DataFrame rows in headers order
+        sep, headers, formatters = self.sep, self.headers, self.formatters
+        if hasattr(rows, 'itertuples'):
+            rows = rows[headers].itertuples(index=False, name=None)
+        for row in rows:
+            if isinstance(row, dict):
+                values = [func(row[header]) for header, func in zip(headers, formatters)]
+            else:
+                values = [func(value) for func, value in zip(formatters, row)]
+            yield sep.join(values) + '\n'
+
+    def _write_lines(self, lines, mod):
+        self._stale = True
+        if self._handle is None:
+            f = self._open(mod)
+            f.write(''.join(lines).encode())
+            f.close()
+            return
+        for line in lines:
+            self._lines.append(line)
+            self._buffered += len(line)
+            if self._buffered >= self.buffer_size:
+                self.flush()
 
     def write_row(self, row, mod='ab'):
-
-
-        if self.out_fn.endswith('.gz'):
-            f = gzip.open(self.out_fn, mod)
-        else:
-            f = open(self.out_fn, mod)
-
-        row = self._dump_row(row)
-        # write
-        line = self.sep.join([ row[header] for header in self.headers]) + '\n'
-        f.write(line)
-        f.close()
+        self._write_lines(self._format_rows([row]), mod)
         return True
 
     def write_rows(self, rows, mod='ab'):
-
-        if self.out_fn.endswith('.gz'):
-            f = gzip.open(self.out_fn, mod)
-        else:
-            f = open(self.out_fn, mod)
-
-        for row in rows:
-            row = self._dump_row(row)
-            # write
-            line = self.sep.join([ row[header] for header in self.headers]) + '\n'
-            f.write(line)
-
-        f.close()
+        self._write_lines(self._format_rows(rows), mod)
         return True
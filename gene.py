@@ -37,10 +37,23 @@ def read_gene_dict_from_dir(in_dir):
         return {}
     if os.path.isfile(in_dir):
         _, fn = os.path.split(in_dir)
-        return {fn: read_gene_list(fn)}
+        return {fn: read_gene_list(in_dir)}
     gene_dict = {}
     for fn in os.listdir(in_dir):
         in_fn = os.path.join(in_dir, fn)
         gene_dict[fn] = read_gene_list(in_fn)
 
     return gene_dict
+
+
+def invert_gene_dict(gene_dict):
+    # gene -> frozenset of the gene lists it belongs to
+    gene_groups = {}
+    for group, genes in gene_dict.items():
+        for gene in genes:
+            gene_groups.setdefault(gene, set()).add(group)
+    return {gene: frozenset(groups) for gene, groups in gene_groups.items()}
+
+
+def read_gene_groups_from_dir(in_dir):
+    return invert_gene_dict(read_gene_dict_from_dir(in_dir))
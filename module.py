@@ -7,7 +7,13 @@
     @License: LICENSE_NAME, see LICENSE for more details.
 """
 import os
-from itertools import tee
+import json
+import time
+import multiprocessing
+import traceback
+from collections import OrderedDict, deque
+from functools import partial
+from itertools import islice, tee
 
 
 class Module(object):
@@ -19,6 +25,8 @@ class Module(object):
                  write_fields=True, dynamic_fields=False,
                  writer_cls=None, write_mode='whole', out_dir='',
                  prefix='', suffix='', chunk_size=1000,
+                 max_open_writers=64, max_buffered_rows=None,
+                 profile=False, checkpoint_fn=None, checkpoint_every=1000000,
                  sample=None,
                  **extra):
         self.sample = sample
@@ -56,25 +64,101 @@ class Module(object):
         self.prefix = prefix
         self.suffix = suffix
         self.chunk_size = chunk_size
+        # sharded output (write_mode other than 'whole'): at most
+        # max_open_writers handles stay open, least recently used closed
+        # first and reopened in append mode, pending rows of all shards
+        # together are capped by max_buffered_rows
+        self.max_open_writers = max_open_writers
+        self.max_buffered_rows = max_buffered_rows
 
         self.meta_dict = {}
         self.writer_dict = {}
+        self.open_writers = OrderedDict()
+        self.buffered_rows = 0
         self.meta_count = {}
+        self.n_records = 0
+        self._skip = 0
 
-    def evaluate(self):
-        gen1, gen2 = tee(self)
+        # checkpoint_fn keeps the record count, meta_count and output sizes
+        # every checkpoint_every records, a rerun resumes writing from it.
+        # The upstream is not skipped: a resumed run reads and processes the
+        # whole input again, and only the writes before the checkpoint are
+        # saved, as records cannot be mapped back to input positions
+        self.checkpoint_fn = checkpoint_fn
+        self.checkpoint_every = checkpoint_every
 
-        if not os.path.exists(self.out_dir):
+        # opt-in, stage timings go to prefix.suffix.profile.json
+        self.profile = profile
+        self.profile_stats = None
+        if profile:
+            self.profile_stats = {
+                'stages': {}, 'bytes': {}, 'peak_chunk': {},
+                'peak_buffered_rows': 0}
+            self._write_line = self._profiled('write_line', self._write_line)
+            self._write_chunk = self._profiled('write_chunk', self._write_chunk)
+            if hasattr(self.in_iter, '_make_record'):  # a myio.Reader
+                self.in_iter._make_record = self._profiled(
+                    'construct', self.in_iter.record_cls)
+
+    def evaluate(self, mode='tee'):
+        """Write the records and return them downstream.
+
+        mode 'tee' writes all records first and returns an iterator over
+        them, buffered in memory, 'stream' returns a generator that writes
+        each record as it is yielded, 'write' writes all records and
+        returns the per meta record counts instead of the records.
+
+        With a checkpoint_fn left by an interrupted run, outputs are cut
+        back to the checkpoint and the records before it are not written
+        again, but they are still produced by the upstream and returned.
+        """
+        if mode not in ('tee', 'stream', 'write'):
+            raise ValueError('Unknown evaluate mode: {}'.format(mode))
+        if self.out_dir and not os.path.exists(self.out_dir):
             os.makedirs(self.out_dir)
+
+        source = self
+        if self.write and self.checkpoint_fn and os.path.exists(self.checkpoint_fn):
+            self._skip = self._resume()
+        if self.profile:
+            self._profile_start = time.perf_counter(), time.process_time()
+            source = self._profiled_iter(source)
+
+        if mode == 'stream':
+            return self._evaluate_stream(source)
+
+        if mode == 'write':
+            gen1, gen2 = source, None
+        else:
+            gen1, gen2 = tee(source)
+
         for meta, record in gen1:
             if self.write:
-                self._write_line(meta, record)
+                self._evaluate_line(meta, record)
 
         if self.write:
             self._write_after_iter()
 
+        if mode == 'write':
+            return dict(self.meta_count)
         return gen2
 
+    def _evaluate_stream(self, source):
+        for meta, record in source:
+            if self.write:
+                self._evaluate_line(meta, record)
+            yield meta, record
+
+        if self.write:
+            self._write_after_iter()
+
+    def _evaluate_line(self, meta, record):
+        # on resume, records before the checkpoint are passed on unwritten
+        if self._skip:
+            self._skip -= 1
+        else:
+            self._write_line(meta, record)
+
     def __iter__(self):
         pass
 
@@ -87,13 +171,29 @@ class Module(object):
         if self.write_mode == 'whole':
             meta = 'ALL'
         chunk = self.meta_dict.get(meta, [])
+        self.n_records += 1
 
         if len(chunk) >= self.chunk_size:
             self._write_chunk(meta, chunk)
             self.meta_dict[meta] = [line]
+            self.buffered_rows -= len(chunk) - 1
         else:
             chunk.append(line)
             self.meta_dict[meta] = chunk
+            self.buffered_rows += 1
+
+        if self.max_buffered_rows and self.buffered_rows >= self.max_buffered_rows:
+            self._write_largest_chunk()
+
+        if self.checkpoint_fn and self.n_records % self.checkpoint_every == 0:
+            self._checkpoint()
+
+    def _write_largest_chunk(self):
+        meta = max(self.meta_dict, key=lambda x: len(self.meta_dict[x]))
+        chunk = self.meta_dict[meta]
+        self._write_chunk(meta, chunk)
+        self.meta_dict[meta] = []
+        self.buffered_rows -= len(chunk)
 
     def _write_chunk(self, meta, chunk):
         dynamic_fields = False
@@ -107,6 +207,10 @@ class Module(object):
             if self.out_fn not in self.out_fns:
                 self.out_fns.append(self.out_fn)
             writer = self.writer_cls(fn=self.out_fn)
+            if self.write_mode == 'whole':
+                writer.open()
+            else:
+                self._open_writer(meta, writer)
             if self.write_headers:
                 writer.write_headers()
             if self.write_fields:
@@ -117,17 +221,46 @@ class Module(object):
             self.writer_dict[meta] = writer
         else:
             writer = self.writer_dict[meta]
+            if self.write_mode != 'whole':
+                self._open_writer(meta, writer)
 
         writer.write_chunk(chunk, dynamic_fields=dynamic_fields)
 
+        if self.profile:
+            stats = self.profile_stats
+            key = str(meta)
+            stats['peak_chunk'][key] = max(stats['peak_chunk'].get(key, 0), len(chunk))
+            # buffered rows only drop at a chunk write, so peaks are seen here
+            stats['peak_buffered_rows'] = max(stats['peak_buffered_rows'], self.buffered_rows)
+
+    def _open_writer(self, meta, writer):
+        if meta in self.open_writers:
+            self.open_writers.move_to_end(meta)
+            return
+        while self.open_writers and len(self.open_writers) >= self.max_open_writers:
+            _, lru = self.open_writers.popitem(last=False)
+            lru.close(final=False)
+        writer.open('a')
+        self.open_writers[meta] = writer
+
     def _write_after_iter(self):
         self._write_last_chunk()
+        for writer in self.writer_dict.values():
+            writer.close()
+        self.open_writers.clear()
         if self.write_stats:
             self._write_stat()
+        if self.profile:
+            self._write_profile()
+        if self.checkpoint_fn and os.path.exists(self.checkpoint_fn):
+            os.remove(self.checkpoint_fn)  # finished, a rerun starts over
 
     def _write_last_chunk(self):
         for meta, chunk in self.meta_dict.items():
-            self._write_chunk(meta, chunk)
+            if chunk or meta not in self.writer_dict:
+                self._write_chunk(meta, chunk)
+        self.meta_dict = {}
+        self.buffered_rows = 0
 
     def _write_stat(self):
         stat_fn = os.path.join(
@@ -135,3 +268,198 @@ class Module(object):
         with open(stat_fn, 'w') as f:
             f.write('\t'.join(map(str, self.meta_count.keys())) + '\n')
             f.write('\t'.join(map(str, self.meta_count.values())) + '\n')
+
+    def _checkpoint(self):
+        # write out every pending row and end the compressed members, so
+        # each output is consistent at its current size
+        self._write_last_chunk()
+        for writer in self.writer_dict.values():
+            writer.close(final=False)
+        self.open_writers.clear()
+
+        state = {
+            'offset': self.n_records,
+            'meta_count': list(self.meta_count.items()),
+            'writers': [[meta, writer.fn, os.path.getsize(writer.fn)]
+                        for meta, writer in self.writer_dict.items()],
+        }
+        tmp_fn = self.checkpoint_fn + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_fn, self.checkpoint_fn)
+
+        if self.write_mode == 'whole':
+            for writer in self.writer_dict.values():
+                writer.open()
+
+    def _resume(self):
+        # truncate outputs to the last checkpoint, returns the records not to
+        # write again, the upstream has to yield the same records in order
+        with open(self.checkpoint_fn) as f:
+            state = json.load(f)
+
+        self.meta_count = dict((meta, count) for meta, count in state['meta_count'])
+        self.n_records = state['offset']
+        for meta, fn, size in state['writers']:
+            with open(fn, 'r+b') as f:
+                f.truncate(size)
+            writer = self.writer_cls(fn=fn, init_mode='a')
+            if self.write_mode == 'whole':
+                writer.open()
+            self.writer_dict[meta] = writer
+            if fn not in self.out_fns:
+                self.out_fns.append(fn)
+        return state['offset']
+
+    def _profiled(self, stage, func):
+        stats = self.profile_stats['stages'].setdefault(
+            stage, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+
+        def wrapper(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats['calls'] += 1
+                stats['wall'] += time.perf_counter() - wall
+                stats['cpu'] += time.process_time() - cpu
+        return wrapper
+
+    def _profiled_iter(self, iterable):
+        # time spent in the upstream generators, between yielded records
+        stats = self.profile_stats['stages'].setdefault(
+            'iterate', {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+        it = iter(iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                stats['calls'] += 1
+                stats['wall'] += time.perf_counter() - wall
+                stats['cpu'] += time.process_time() - cpu
+            yield item
+
+    def _write_profile(self):
+        # write_line includes the write_chunk calls it triggers, iterate the
+        # construct calls, bytes are the closed output sizes on disk
+        stats = dict(self.profile_stats)
+        stats['bytes'] = dict((str(meta), os.path.getsize(writer.fn))
+                              for meta, writer in self.writer_dict.items())
+        wall = time.perf_counter() - self._profile_start[0]
+        records = sum(self.meta_count.values())
+        stats.update({
+            'wall': wall,
+            'cpu': time.process_time() - self._profile_start[1],
+            'records': records,
+            'records_per_second': records / wall if wall else None})
+        profile_fn = os.path.join(
+            self.out_dir, self.prefix + '.' + self.suffix + '.profile.json')
+        with open(profile_fn, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+
+
+class ParallelMapError(Exception):
+    """A ParallelMapModule transform failed, with the worker traceback."""
+
+    def __init__(self, record, tb):
+        Exception.__init__(self, record, tb)
+        self.record = record  # repr of the offending (meta, record), or chunk
+        self.tb = tb
+
+    def __str__(self):
+        return 'Failed on {}\n{}'.format(self.record, self.tb)
+
+
+def _init_map_worker(func, per_chunk):
+    # pool workers only, in process stages bind their own func
+    global _map_func, _map_per_chunk
+    _map_func = func
+    _map_per_chunk = per_chunk
+
+
+def _map_worker_chunk(chunk):
+    return _map_chunk(_map_func, _map_per_chunk, chunk)
+
+
+def _map_chunk(func, per_chunk, chunk):  # chunk: [(meta, record), ...]
+    # errors come back as values, so the parent sees the offending record
+    if per_chunk:
+        try:
+            return list(func(chunk)), None
+        except Exception:
+            return None, (repr(chunk), traceback.format_exc())
+
+    res = []
+    for meta, record in chunk:
+        try:
+            item = func(meta, record)
+        except Exception:
+            return None, (repr((meta, record)), traceback.format_exc())
+        if item is not None:
+            res.append(item)
+    return res, None
+
+
+class ParallelMapModule(Module):
+    """Map func over the (meta, record) pairs of upstream in a process pool.
+
+    Per record, func(meta, record) returns a (meta, record) pair, or None to
+    drop the record. With per_chunk, func(chunk) takes a list of chunk_size
+    pairs and returns a list of pairs. func must be picklable, e.g. defined
+    at module level. Output keeps the upstream order, and is written by the
+    usual evaluate, processes=0 maps in this process.
+    """
+
+    def __init__(self, upstream, func, per_chunk=False, processes=None,
+                 **kwargs):
+        Module.__init__(self, **kwargs)
+        self.in_iter = upstream
+        self.func = func
+        self.per_chunk = per_chunk
+        self.processes = processes
+
+    def _chunks(self):
+        it = iter(self.in_iter)
+        while True:
+            chunk = list(islice(it, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _submit(self, pool):
+        # at most 2 chunks per process in flight, upstream is read on the
+        # caller's thread only as results are consumed
+        pending = deque()
+        max_pending = 2 * (self.processes or multiprocessing.cpu_count())
+        for chunk in self._chunks():
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(_map_worker_chunk, (chunk,)))
+        while pending:
+            yield pending.popleft().get()
+
+    def __iter__(self):
+        if self.processes == 0:
+            results = map(partial(_map_chunk, self.func, self.per_chunk), self._chunks())
+            pool = None
+        else:
+            pool = multiprocessing.Pool(self.processes, initializer=_init_map_worker,
+                                        initargs=(self.func, self.per_chunk))
+            results = self._submit(pool)
+        try:
+            for res, error in results:
+                if error is not None:
+                    raise ParallelMapError(*error)
+                for item in res:
+                    yield item
+        except BaseException:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
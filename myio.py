@@ -7,17 +7,83 @@
     @Copyright: (c) 2018-06 by Lingxi Chen (chanlingxi@gmail.com).
     @License: LICENSE_NAME, see LICENSE for more details.
 """
+import io
 import os
 import gzip
+import keyword
 import csv
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import islice, zip_longest
+
 import vcf
 import yaml
 import pysam
+import numpy as np
+import pandas as pd
+from tenxtools.utils import bgzf
+
+
+def format_value(x):  # None, int, float, list, same output as before
+    if isinstance(x, str):
+        return x or '.'
+    if isinstance(x, list):
+        return ','.join(map(format_value, x)) if x else '.'
+    if x == 0:
+        return '0'
+    if not x:
+        return '.'   # notice not 0 is True
+    return str(x)
+
+
+# --- field codecs: name -> (parse, format), '.' is missing --- #
+def _missing(x):
+    return x is None or x == '' or x == '.'
+
+
+def _parse_scalar(func):
+    def parse(x):
+        return None if _missing(x) else func(x)
+    return parse
+
+
+def _parse_list_of(func):
+    def parse(x):
+        if isinstance(x, (list, tuple)):
+            return [func(v) for v in x]
+        if _missing(x):
+            return []
+        return [func(v) for v in x.split(',') if v]
+    return parse
+
+
+def _format_scalar(x):
+    return '.' if x is None or x == '' else str(x)
+
+
+def _format_list_of(x):
+    return ','.join(map(str, x)) if x else '.'
+
+
+codecs = {
+    'raw': (lambda x: x, format_value),
+    'str': (_parse_scalar(str), _format_scalar),
+    'int': (_parse_scalar(int), _format_scalar),
+    'float': (_parse_scalar(float), _format_scalar),
+    'str_list': (_parse_list_of(str), _format_list_of),
+    'int_list': (_parse_list_of(int), _format_list_of),
+    'float_list': (_parse_list_of(float), _format_list_of),
+}
+
+
+def register_codec(name, parse, format):
+    codecs[name] = (parse, format)
 
 
 class Record(object):
 
     fields = []
+    converters = {}  # field -> converter as in _validate, for read_columns
     sep = '\t'
 
     def __init__(self, stream_or_str=None, parent=None, args=None, sep='\t',
@@ -52,6 +118,8 @@ class Record(object):
         pass
 
     def _validate(self, x, func=None):
+        if isinstance(func, str):  # codec name
+            return codecs[func][0](x)
         if func in [None, int, float]:
             if not x:
                 return x
@@ -72,23 +140,16 @@ class Record(object):
         return line.split(sep)
 
     def _format_list(self, x, sep=','):
-        return sep.join(map(self._format_value, x))
+        return sep.join(map(format_value, x))
 
     def _format_value(self, x):  # None, int, float, list
-        if x == 0:
-            return '0'
-        if not x:
-            return '.'   # notice not 0 is True
-        if type(x) == list:
-            return self._format_list(x)
-        return str(x)
-
-    def _parse_value(self, x):  # None, int, float, list
+        return format_value(x)
+
+    def _parse_value(self, x):  # None, float, list
         if x == '.':
             return None
-        splits = x.split(',')
-        if splits:
-            return map(self._parse_value, splits)
+        if ',' in x:
+            return [self._parse_value(v) for v in x.split(',') if v]
         return float(x)
 
     def __repr__(self):
@@ -108,26 +169,196 @@ class Record(object):
         pass
 
 
-def safe_open(fn, mode):
+class SlottedRecord(object):
+    """Base of the classes built by record_class, records have no __dict__."""
+
+    __slots__ = ('parent',)
+
+    fields = []
+    converters = {}
+    sep = '\t'
+
+    def __init__(self, stream_or_str=None, parent=None, args=None, sep=None,
+                 **kwargs):  # sep is fixed by the class
+        self.parent = parent
+        args = args or {}
+
+        if parent:
+            self.from_parent()
+        elif stream_or_str:
+            self.parse(stream_or_str)
+        elif args:
+            self.set(**args)
+        else:
+            self.set(**kwargs)
+
+    @classmethod
+    def from_line(cls, line):
+        record = cls.__new__(cls)
+        record.parent = None
+        record.parse(line)
+        return record
+
+    def from_parent(self, **kwargs):
+        pass
+
+    _validate = Record._validate
+    _parse_list = Record._parse_list
+    _parse_value = Record._parse_value
+    _format_list = Record._format_list
+    _format_value = Record._format_value
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def _convert_expr(field, i, func):  # inline Record._validate(field, func)
+    if isinstance(func, str):  # codec name
+        return "_c{1}({0})".format(field, i)
+    if func is None:
+        return "None if {0} == '.' else {0}".format(field)
+    if func in (int, float):
+        return "{0} if not {0} else (None if {0} == '.' else _c{1}({0}))".format(field, i)
+    if func is str:
+        return "str({0}) if {0} else ''".format(field)
+    return "_c{1}({0})".format(field, i)
+
+
+_record_template = '''
+def set(_self, {params}**_kwargs):
+{assigns}
+    pass
+
+def parse(_self, line):
+    _self.set(*line.rstrip('\\r\\n').split(_sep)[:{n}])
+
+def __repr__(_self):
+    return _template.format({values})
+'''
+
+
+def record_class(name, schema, sep='\t', base=SlottedRecord):
+    """Build a __slots__ record class with compiled set, parse and __repr__.
+
+    schema lists field names or (field, converter) pairs, converters follow
+    Record._validate, e.g. [('chr', None), ('start', int), ('mean', float)],
+    or name a codec, e.g. ('starts', 'int_list'), see codecs.
+    """
+    fields, converters = [], {}
+    for field in schema:
+        field, func = (field, None) if isinstance(field, str) else field
+        if not field.isidentifier() or keyword.iskeyword(field):
+            raise ValueError('Invalid record field name: {}'.format(field))
+        if isinstance(func, str) and func not in codecs:
+            raise ValueError('Unknown record codec: {}'.format(func))
+        fields.append(field)
+        converters[field] = func
+
+    namespace = {'_sep': sep, '_template': sep.join(['{}'] * len(fields))}
+    for i, field in enumerate(fields):
+        func = converters[field]
+        if isinstance(func, str):
+            namespace['_c{}'.format(i)], namespace['_f{}'.format(i)] = codecs[func]
+        else:
+            namespace['_c{}'.format(i)], namespace['_f{}'.format(i)] = func, format_value
+    source = _record_template.format(
+        params=''.join('{}=None, '.format(field) for field in fields),
+        assigns='\n'.join(
+            '    _self.{} = {}'.format(field, _convert_expr(field, i, converters[field]))
+            for i, field in enumerate(fields)),
+        n=len(fields),
+        values=''.join('_f{}(_self.{}), '.format(i, field) for i, field in enumerate(fields)))
+    exec(source, namespace)
+
+    # columnar loaders only need the scalar type of codec fields
+    for field, func in converters.items():
+        if isinstance(func, str):
+            converters[field] = {'int': int, 'float': float}.get(func, codecs[func][0])
+
+    return type(name, (base,), {
+        '__slots__': tuple(fields),
+        'fields': fields,
+        'converters': converters,
+        'sep': sep,
+        'set': namespace['set'],
+        'parse': namespace['parse'],
+        '__repr__': namespace['__repr__'],
+    })
+
+
+def safe_open(fn, mode, threads=0):
     if not fn:
         return None
+    if fn.endswith('gz') and threads and mode[0] in 'wa':
+        return bgzf.BgzfWriter(fn, mode, threads=threads)
     if fn.endswith('gz'):
+        if 'b' not in mode and 't' not in mode:
+            mode += 't'  # text like open(), gzip defaults to binary
         return gzip.open(fn, mode)
     else:
         return open(fn, mode)
 
 
+def buffered_open(fn, mode, buffer_size, threads=0):
+    # text handle for writing, buffered before compression for .gz
+    mode = mode.replace('t', '').replace('b', '')
+    if fn.endswith('gz') and threads:
+        return bgzf.BgzfWriter(fn, mode, threads=threads)
+    if fn.endswith('gz'):
+        raw = gzip.GzipFile(fn, mode + 'b')
+        return io.TextIOWrapper(io.BufferedWriter(raw, buffer_size))
+    return open(fn, mode, buffering=buffer_size)
+
+
 class Writer(object):
 
     def __init__(self, fn=None, record_cls=Record,
-                 fields_prefix='#',
+                 fields_prefix='#', buffer_size=1024*1024,
+                 threads=0, tabix_index=None, init_mode='w',
                  *args, **kwargs):
         self.fn = fn
 
         self.fields_prefix = fields_prefix
         self.sep = record_cls.sep
         self.fields = record_cls.fields
-        self.write('', 'w')
+        self.buffer_size = buffer_size
+        self.threads = threads  # > 0, write .gz as BGZF compressed in threads
+        self.tabix_index = tabix_index  # pysam.tabix_index kwargs, on final close
+        self._handle = None
+        self._stale = False  # written since the last index
+        self.write('', init_mode)  # 'a' keeps the content, e.g. on resume
+
+    def open(self, mode='a'):
+        # keep one buffered handle until close instead of one per write,
+        # the mode of each write call is ignored while it is open
+        if self._handle is None:
+            self._handle = buffered_open(self.fn, mode, self.buffer_size,
+                                         threads=self.threads)
+        return self
+
+    def flush(self):
+        if self._handle is not None:
+            self._handle.flush()
+
+    def close(self, final=True):
+        # final=False only ends the session, e.g. an evicted shard that is
+        # reopened later, the tabix index is built on a final close only
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        if final and self._stale and self.tabix_index is not None:
+            bgzf.tabix_index(self.fn, **self.tabix_index)
+            self._stale = False
+
+    @property
+    def closed(self):
+        return self._handle is None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def write_headers(self, mode='a'):
         pass
@@ -137,22 +368,36 @@ class Writer(object):
             fields = self.fields
 
         line = self.fields_prefix + self.sep.join(fields) + '\n'
-        with safe_open(self.fn, mode) as f:
-            f.write(line)
+        self.write(line, mode)
         return True
 
     def write_chunk(self, chunk, mode='a', dynamic_fields=False):
-        with safe_open(self.fn, mode) as f:
-            for i, record in enumerate(chunk):
-                if i == 0 and dynamic_fields:
-                    self.write_fields(fields=record.fields)
-                f.write(str(record) + '\n')
+        lines = []
+        for i, record in enumerate(chunk):
+            if i == 0 and dynamic_fields:
+                self.write_fields(fields=record.fields)
+            lines.append(str(record) + '\n')
+        self.write(''.join(lines), mode)
 
     def write(self, content, mode='a'):
-        with safe_open(self.fn, mode) as f:
+        self._stale = True
+        if self._handle is not None:
+            self._handle.write(content)
+            return
+        with safe_open(self.fn, mode, threads=self.threads) as f:
             f.write(content)
 
 
+def to_array(values, func=None):
+    # typed column from strings, int columns with missing values are float
+    if func in (int, float):
+        missing = [not x or x == '.' for x in values]
+        if any(missing):
+            return np.array([np.nan if m else float(x) for x, m in zip(values, missing)])
+        return np.array([func(x) for x in values], dtype=np.int64 if func is int else np.float64)
+    return np.array([Record._validate(None, x, func) for x in values], dtype=object)
+
+
 class Reader(object):  # currently just csv, tsv file
 
     record_cls = Record
@@ -161,7 +406,7 @@ class Reader(object):  # currently just csv, tsv file
                  in_data=None, in_fn=None,
                  record_cls=Record,
                  file_type='csv', sep=',', has_header=False,
-                 sample=None):
+                 sample=None, threads=0):
         self.in_data = in_data
         self.in_fn = in_fn
         self.record_cls = record_cls
@@ -169,8 +414,10 @@ class Reader(object):  # currently just csv, tsv file
         self.file_type = file_type
         self.sep = sep
         self.has_header = has_header
+        self.threads = threads  # > 0, decompress .gz input ahead of parsing
 
         self.sample = sample
+        self._make_record = None  # record_cls, or a profiled wrapper of it
         if isinstance(self.in_fn, str) and self.in_fn.endswith('gz'):
             self.tbx = pysam.TabixFile(self.in_fn)
 
@@ -181,7 +428,7 @@ class Reader(object):  # currently just csv, tsv file
 
     def _read(self, in_fn):
 
-        for line in safe_open(in_fn, 'rt'):
+        for line in bgzf.iter_lines(in_fn, threads=self.threads):
             if self.file_type != 'vcf' and line.startswith('#'):
                 continue
 
@@ -244,34 +491,140 @@ class Reader(object):  # currently just csv, tsv file
             if condition_func and condition_func(record):
                 yield meta, record
 
+    def _line_parser(self):
+        # line -> record, built once per query instead of once per line
+        record_cls = self.record_cls
+        if hasattr(record_cls, 'from_line') and record_cls.sep == self.sep:
+            return record_cls.from_line
+        fields, sep = record_cls.fields, self.sep
+
+        def parse(line):
+            return record_cls(args=dict(zip(fields, line.split(sep))))
+        return parse
+
     def fetch(self, chrom, start, end, condition_func=None):
+        parse = self._line_parser()
         for line in self.tbx.fetch(chrom, start, end):
-            row = dict(zip(self.record_cls.fields, line.split(self.sep)))
-            record = self.record_cls(args=row)
+            record = parse(line)
             if condition_func is None:
                 yield None, record
             elif condition_func and condition_func(record):
                 yield None, record
 
+    def fetch_many(self, regions, condition_func=None,
+                   start_field='start', end_field='end', zero_based=False):
+        """Fetch many (chrom, start, end) regions with merged tabix queries.
+
+        Regions use the same coordinates as fetch. Overlapping or adjacent
+        regions are merged into one tabix iteration, and each record is
+        routed to every region it overlaps using its start_field and
+        end_field, 1-based closed unless zero_based. Empty regions, start >=
+        end, get no records as in fetch. Yields (region, record) grouped by
+        region in input order, shared records are the same object.
+        """
+        parse = self._line_parser()
+        hits = [[] for _ in regions]
+
+        chrom_regions = OrderedDict()
+        for i, (chrom, start, end) in enumerate(regions):
+            if start < end:
+                chrom_regions.setdefault(chrom, []).append((start, end, i))
+
+        for chrom, queries in chrom_regions.items():
+            queries.sort()
+            blocks = [[queries[0]]]
+            block_end = queries[0][1]
+            for query in queries[1:]:
+                if query[0] <= block_end:
+                    blocks[-1].append(query)
+                    block_end = max(block_end, query[1])
+                else:
+                    blocks.append([query])
+                    block_end = query[1]
+
+            for block in blocks:
+                starts = [start for start, _, _ in block]
+                block_end = max(end for _, end, _ in block)
+                lo = 0
+                try:
+                    lines = self.tbx.fetch(chrom, block[0][0], block_end)
+                except ValueError:  # chrom not in index
+                    continue
+                for line in lines:
+                    record = parse(line)
+                    if condition_func and not condition_func(record):
+                        continue
+                    start = int(getattr(record, start_field))
+                    if not zero_based:
+                        start -= 1
+                    end = getattr(record, end_field, None)
+                    end = int(end) if end not in (None, '', '.') else start + 1
+                    while lo < len(block) and block[lo][1] <= start:
+                        lo += 1
+                    for q_start, q_end, i in block[lo:bisect_left(starts, end)]:
+                        if q_end > start:
+                            hits[i].append(record)
+
+        for region, records in zip(regions, hits):
+            for record in records:
+                yield region, record
+
+    def _iter_columns(self, rows, fields, chunk_size=None):
+        converters = self.record_cls.converters
+        while True:
+            chunk = list(islice(rows, chunk_size)) if chunk_size else list(rows)
+            if chunk_size and not chunk:
+                return
+            cols = list(zip_longest(*chunk, fillvalue=''))
+            cols += [('',) * len(chunk)] * (len(fields) - len(cols))
+            yield dict((field, to_array(col, converters.get(field)))
+                       for field, col in zip(fields, cols))
+            if not chunk_size:
+                return
+
+    def read_columns(self, chunk_size=None):
+        """Parse in_fn straight into typed numpy columns, no Record per row.
+
+        Converters come from record_cls.converters. Returns {field: array},
+        or with chunk_size a generator of such dicts of at most chunk_size
+        rows.
+        """
+        rows = csv.reader(self._read(self.in_fn), delimiter=self.sep,
+                          skipinitialspace=True)
+        fields = next(rows, []) if self.has_header else self.fields
+        chunks = self._iter_columns(rows, fields, chunk_size)
+        return chunks if chunk_size else next(chunks)
+
+    def to_frame(self, chunk_size=None):
+        if chunk_size:
+            return (pd.DataFrame(cols) for cols in self.read_columns(chunk_size))
+        return pd.DataFrame(self.read_columns())
+
+    def fetch_columns(self, chrom, start, end, chunk_size=None):
+        rows = (line.split(self.sep) for line in self.tbx.fetch(chrom, start, end))
+        chunks = self._iter_columns(rows, self.record_cls.fields, chunk_size)
+        return chunks if chunk_size else next(chunks)
+
     def read_record(self):
+        make = self._make_record or self.record_cls
         for i, row_or_record in enumerate(self.in_iter):
             if isinstance(row_or_record, dict):
                 row_or_record['sample'] = self.sample
-                record = self.record_cls(args=row_or_record)
+                record = make(args=row_or_record)
                 meta = None
 
             elif isinstance(row_or_record, tuple):
                 meta, record = row_or_record
                 if isinstance(record, dict):
                     record['sample'] = self.sample
-                    record = self.record_cls(args=record)
+                    record = make(args=record)
                 elif not isinstance(record, self.record_cls):
                     record.sample = self.sample
-                    record = self.record_cls(parent=record)
+                    record = make(parent=record)
             elif not isinstance(row_or_record, self.record_cls):
                 meta = None
                 row_or_record.sample = self.sample
-                record = self.record_cls(parent=row_or_record)
+                record = make(parent=row_or_record)
             else:
                 meta = None
                 record.sample = self.sample
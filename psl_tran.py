@@ -8,33 +8,375 @@
     @Copyright: (c) 2018-04 by Lingxi Chen (chanlingxi@gmail.com).
     @License: LICENSE_NAME, see LICENSE for more details.
 """
+import os
+import sys
+import argparse
+import threading
+import multiprocessing
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import chain, groupby
+from operator import add, itemgetter
+
+import numpy as np
 import pysam
 from tenxtools.utils import genomic_region
 from tenxtools.utils import gene
+from tenxtools.utils import basic
+
+
+class TabixPool(object):
+    """LRU pool of open pysam.TabixFile handles, keyed by path.
+
+    Handles are kept per thread, and the pool is dropped after a fork so a
+    child process never shares file offsets with its parent. close() closes
+    the handles of every thread, call it once no other thread fetches.
+    Handles of finished threads are closed when a new thread starts using
+    the pool.
+    """
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._threads = {}  # thread -> its handles, under _lock
+
+    def _handles(self):
+        if self._pid != os.getpid():  # forked, do not touch parent handles
+            self._pid = os.getpid()
+            self._local = threading.local()
+            self._threads = {}
+        handles = getattr(self._local, 'handles', None)
+        if handles is None:
+            handles = self._local.handles = OrderedDict()
+            with self._lock:
+                for thread in [t for t in self._threads if not t.is_alive()]:
+                    self._close_handles(self._threads.pop(thread))
+                self._threads[threading.current_thread()] = handles
+        return handles
+
+    @staticmethod
+    def _close_handles(handles):
+        while handles:
+            _, tbx = handles.popitem()
+            tbx.close()
+
+    def get(self, fn):
+        handles = self._handles()
+        tbx = handles.get(fn)
+        if tbx is not None:
+            handles.move_to_end(fn)
+            with self._lock:
+                self.hits += 1
+            return tbx
+
+        tbx = pysam.TabixFile(fn)
+        handles[fn] = tbx
+        while len(handles) > self.max_size:
+            _, old_tbx = handles.popitem(last=False)
+            old_tbx.close()
+        with self._lock:
+            self.misses += 1
+        return tbx
+
+    def close(self):
+        self._handles()  # drops the registry of the parent after a fork
+        with self._lock:
+            for handles in self._threads.values():
+                self._close_handles(handles)
+
+    def stats(self):
+        self._handles()
+        with self._lock:
+            n_open = sum(len(handles) for handles in self._threads.values())
+        return {'hits': self.hits, 'misses': self.misses, 'open': n_open}
+
+
+tabix_pool = TabixPool()
+
+
+class TranscriptIndex(object):
+    """In-memory nested containment list over the transcript table.
+
+    Intervals are 0-based half-open [left, right), and query hits come back
+    in file order, so results match a tabix fetch only if the table is
+    indexed 0-based, i.e. tabix -0 or pysam.tabix_index(zerobased=True), as
+    its left column is.
+    Each chromosome is built on its first query. Every row is made into a
+    Transcript once, and the same object is returned by later queries.
+    """
+
+    def __init__(self, rows, make=None):
+        self._rows = rows   # {chrom: [(left, right, row), ...]} in file order
+        self._nclists = {}
+        self.make = make    # row -> Transcript, rows are Transcripts without it
+        self._trans = {}
+
+    @classmethod
+    def from_tabix(cls, fn, pool=None):
+        tbx = (pool or tabix_pool).get(fn)
+        rows = {}
+        for chrom in tbx.contigs:
+            chrom_rows = rows.setdefault(chrom, [])
+            for row in tbx.fetch(chrom):
+                tran = Transcript(row)
+                chrom_rows.append((tran.left - 1, tran.right, tran))
+        return cls(rows)
+
+    @classmethod
+    def from_table(cls, table):
+        rows = {}
+        for chrom, (i, j) in table.chrom_ranges().items():
+            rows[chrom] = list(zip(table.left[i:j].tolist(),
+                                   table.right[i:j].tolist(), range(i, j)))
+        return cls(rows, make=table.transcript)
+
+    @staticmethod
+    def _build(chrom_rows):
+        # sublist: (rights, nodes), node: (left, right, order, row, sublist)
+        # siblings never contain each other, so their rights are sorted too
+        entries = sorted(
+            (left, -right, order, row)
+            for order, (left, right, row) in enumerate(chrom_rows))
+        root = ([], [])
+        stack = []
+        for left, right, order, row in entries:
+            right = -right
+            while stack and stack[-1][0] < right:
+                stack.pop()
+            parent = stack[-1][1] if stack else root
+            sublist = ([], [])
+            parent[0].append(right)
+            parent[1].append((left, right, order, row, sublist))
+            stack.append((right, sublist))
+        return root
+
+    def _transcript(self, row):
+        if self.make is None:
+            return row
+        tran = self._trans.get(row)
+        if tran is None:
+            tran = self._trans[row] = self.make(row)
+        return tran
+
+    def _nclist(self, chrom):
+        nclist = self._nclists.get(chrom)
+        if nclist is None and chrom in self._rows:
+            nclist = self._nclists[chrom] = self._build(self._rows[chrom])
+        return nclist
+
+    @classmethod
+    def _query(cls, sublist, start, end, hits):
+        rights, nodes = sublist
+        for i in range(bisect_right(rights, start), len(nodes)):
+            left, right, order, row, child = nodes[i]
+            if left >= end:
+                break
+            hits.append((order, row))
+            if child[0]:
+                cls._query(child, start, end, hits)
+
+    @property
+    def contigs(self):
+        return list(self._rows)
+
+    def fetch_chrom(self, chrom, start=None):
+        if start:  # transcripts ending after start, in file order
+            return self.fetch(chrom, start, sys.maxsize)
+        return [self._transcript(row) for _, _, row in self._rows.get(chrom, [])]
+
+    def fetch(self, chrom, start, end):
+        nclist = self._nclist(chrom)
+        if nclist is None or start >= end:  # empty region, as pysam
+            return []
+        hits = []
+        self._query(nclist, start, end, hits)
+        hits.sort()
+        return [self._transcript(row) for _, row in hits]
+
+
+class TranscriptTable(object):
+    """Memory-mapped struct-of-arrays copy of the transcript table.
+
+    Written once by compile_transcript_table. Every column is a .npy file
+    opened with mmap_mode='r', so startup does no parsing and worker
+    processes share the pages. String fields index into one string table,
+    decoded once at load, and comma separated int fields are flattened with
+    an offsets array.
+    """
+
+    str_fields = ['source', 'version', 'protein_ens_id', 'col8', 'strand',
+                  'name', 'ens_id', 'gtf_name', 'biotype', 'chrom',
+                  'cytoband', 'exon_num', 'cds_info', 'gene']
+    int_fields = ['left', 'right']
+    list_fields = ['start_condon', 'end_condon', 'exon_lens', 'exon_starts']
+
+    def __init__(self, table_dir):
+        self.table_dir = table_dir
+        data = self._load('strings').tobytes()
+        offsets = self._load('string_offsets').tolist()
+        self.strings = [data[i:j].decode() for i, j in zip(offsets, offsets[1:])]
+        self.columns = {}
+        for field in self.str_fields + self.int_fields:
+            self.columns[field] = self._load(field)
+        for field in self.list_fields:
+            self.columns[field] = (self._load(field),
+                                   self._load(field + '_offsets'))
+        self.left = self.columns['left']
+        self.right = self.columns['right']
+
+    def _load(self, name):
+        # plain ndarray over the mapped pages, memmap indexing is slow
+        return np.load(os.path.join(self.table_dir, name + '.npy'), mmap_mode='r').view(np.ndarray)
+
+    def __len__(self):
+        return len(self.left)
+
+    def chrom_ranges(self):
+        # rows are grouped by chrom in file order
+        chroms = self.columns['chrom']
+        if not len(chroms):
+            return OrderedDict()
+        starts = np.flatnonzero(np.diff(chroms)) + 1
+        starts = [0] + starts.tolist()
+        ends = starts[1:] + [len(chroms)]
+        return OrderedDict((self.strings[chroms[i]], (i, j))
+                           for i, j in zip(starts, ends))
+
+    def transcript(self, i):
+        values = {}
+        for field in self.str_fields:
+            values[field] = self.strings[self.columns[field][i]]
+        for field in self.int_fields:
+            values[field] = int(self.columns[field][i])
+        for field in self.list_fields:
+            data, offsets = self.columns[field]
+            values[field] = data[offsets[i]:offsets[i+1]].tolist()
+        return Transcript(**values)
+
+
+def compile_transcript_table(fn, table_dir, pool=None):
+    """Parse the tabix indexed transcript table once into TranscriptTable."""
+    if not os.path.exists(table_dir):
+        os.makedirs(table_dir)
+
+    string_ids = OrderedDict()
+    columns = {field: [] for field in TranscriptTable.str_fields + TranscriptTable.int_fields}
+    lists = {field: ([], [0]) for field in TranscriptTable.list_fields}
+
+    tbx = (pool or tabix_pool).get(fn)
+    for chrom in tbx.contigs:
+        for row in tbx.fetch(chrom):
+            tran = Transcript(row)
+            for field in TranscriptTable.str_fields:
+                value = getattr(tran, field)
+                columns[field].append(string_ids.setdefault(value, len(string_ids)))
+            columns['left'].append(tran.left - 1)
+            columns['right'].append(tran.right)
+            for field in TranscriptTable.list_fields:
+                data, offsets = lists[field]
+                data.extend(getattr(tran, field))
+                offsets.append(len(data))
+
+    strings = [x.encode() for x in string_ids]
+    string_offsets = np.cumsum([0] + [len(x) for x in strings])
+
+    def save(name, values, dtype):
+        np.save(os.path.join(table_dir, name + '.npy'), np.asarray(values, dtype=dtype))
+
+    save('strings', np.frombuffer(b''.join(strings), dtype=np.uint8), np.uint8)
+    save('string_offsets', string_offsets, np.int64)
+    for field in TranscriptTable.str_fields:
+        save(field, columns[field], np.int32)
+    for field in TranscriptTable.int_fields:
+        save(field, columns[field], np.int64)
+    for field, (data, offsets) in lists.items():
+        save(field, data, np.int64)
+        save(field + '_offsets', offsets, np.int64)
+    return table_dir
 
 
 class Reader(object):
 
-    def __init__(self, fn, gene_list=None):
+    def __init__(self, fn, gene_list=None, pool=None, backend='tabix',
+                 table_dir=None, canonical_fn=None):
         self._fn = fn
-        self.gene_list = gene.read_gene_list_from_dir(gene_list)
+        self.gene_list = gene.read_gene_dict_from_dir(gene_list)
+        self.gene_groups = gene.invert_gene_dict(self.gene_list)
+        self.pool = pool or tabix_pool
+
+        self.canonical = read_canonical_table(canonical_fn)
+
+        if backend == 'tabix' and table_dir:
+            raise ValueError('table_dir is only read by the index backend')
+        if backend == 'tabix':
+            self.index = None
+        elif backend == 'index' and table_dir:
+            self.index = TranscriptIndex.from_table(TranscriptTable(table_dir))
+        elif backend == 'index':
+            self.index = TranscriptIndex.from_tabix(fn, pool=self.pool)
+        else:
+            raise ValueError('Unknown transcript backend: {}'.format(backend))
 
     def fetch(self, chrom, pos1, pos2):
         if pos1 > pos2:
             start, end = pos2, pos1
         else:
             start, end = pos1, pos2
-        tbx = pysam.TabixFile(self._fn)
+        if self.index is not None:
+            for tran in self.index.fetch(chrom, start, end):
+                yield tran
+            return
+        tbx = self.pool.get(self._fn)
+        try:
+            # materialize, pooled handles cannot serve interleaved iterators
+            rows = list(tbx.fetch(chrom, start, end))
+        except Exception:
+            return
+        for row in rows:
+            yield Transcript(row)
+
+    def fetch_extended(self, chrom, pos1, pos2, extend=20000):
+        # transcripts whose [left - extend, right + extend] overlaps the region
+        start, end = min(pos1, pos2), max(pos1, pos2)
+        return self.fetch(chrom, max(start - extend, 0), end + extend)
+
+    @property
+    def contigs(self):
+        if self.index is not None:
+            return self.index.contigs
+        return list(self.pool.get(self._fn).contigs)
+
+    def fetch_chrom(self, chrom, start=None):
+        # whole chromosome in file order, i.e. sorted by transcript left,
+        # from start on only transcripts ending after it
+        if self.index is not None:
+            for tran in self.index.fetch_chrom(chrom, start):
+                yield tran
+            return
+        tbx = self.pool.get(self._fn)
         try:
-            for i, row in enumerate(tbx.fetch(chrom, start, end)):
-                yield Transcript(row)
+            if start:
+                rows = tbx.fetch(chrom, start, multiple_iterators=True)
+            else:
+                rows = tbx.fetch(chrom, multiple_iterators=True)
         except Exception:
             return
+        for row in rows:
+            yield Transcript(row)
 
     def fetch_genes_trans(self, chrom, pos1, pos2):
+        return self._group_by_gene(self.fetch(chrom, pos1, pos2))
+
+    @staticmethod
+    def _group_by_gene(trans):
         groups = []
         gene = None
-        for i, tran in enumerate(self.fetch(chrom, pos1, pos2)):
+        for i, tran in enumerate(trans):
             if gene != tran.gene:
                 if groups:
                     yield groups
@@ -51,14 +393,55 @@ class Reader(object):
     def fetch_genes_tran_by_region(self, chrom, pos1, pos2):
         genes_trans = self.fetch_genes_trans(chrom, pos1, pos2)
         for i, gene_trans in enumerate(genes_trans):
-            tran = self.choose_tran_from_group(gene_trans)
+            tran = self.choose_tran(gene_trans)
             if not tran:
                 continue
-            for group, genes in self.gene_list.items():
-                if tran.gene in genes:
-                    tran.group.append(group)
+            self._tag_group(tran)
             yield tran
 
+    def _tag_group(self, tran):
+        groups = self.gene_groups.get(tran.gene)
+        if groups:  # indexed transcripts are shared, so tag idempotently
+            tran.group = sorted(groups)
+
+    def annotate_points(self, points, extend=None):
+        """Annotate breakpoints with one merge sweep per chromosome.
+
+        points is a sequence of (chrom, pos), grouped by chrom and sorted by
+        pos. Yields (chrom, pos, [(tran, (region_class, region)), ...]) for
+        every point, picking the same transcripts as
+        fetch_genes_tran_by_point. extend overrides the promoter/terminator
+        window used for the labels.
+        """
+        for chrom, chrom_points in groupby(points, key=itemgetter(0)):
+            # sweep from the first point, not from the chromosome start
+            first = next(chrom_points)
+            chrom_points = chain([first], chrom_points)
+            trans = self.fetch_chrom(chrom, max(first[1], 0))
+            pending = next(trans, None)
+            active = []
+            prev_pos = None
+            for _, pos in chrom_points:
+                if prev_pos is not None and pos < prev_pos:
+                    raise ValueError(
+                        'Points are not sorted: {}:{} after {}:{}'.format(
+                            chrom, pos, chrom, prev_pos))
+                prev_pos = pos
+                # same overlap as the tabix query [pos, pos + 1)
+                while pending is not None and pending.left - 1 <= pos:
+                    self._tag_group(pending)
+                    active.append(pending)
+                    pending = next(trans, None)
+                active = [tran for tran in active if tran.right > pos]
+
+                annotations = []
+                for gene_trans in self._group_by_gene(active):
+                    tran = self.choose_tran(gene_trans)
+                    if tran:
+                        annotations.append(
+                            (tran, tran.mark_functional_region(pos, extend)))
+                yield chrom, pos, annotations
+
     def fetch_genes_tran_by_seg(self, chrom, pos, strand, seg_extend=500000):
         if strand == '+':
             start, end = pos - seg_extend, pos
@@ -67,6 +450,38 @@ class Reader(object):
         chrom, start, end = genomic_region.GenomicRegion.safe_genomic_region(chrom, start, end)
         return self.fetch_genes_tran_by_region(chrom, start, end)
 
+    def choose_tran(self, trans):
+        # same choice as choose_tran_from_group with the default biotypes,
+        # from the canonical table or the choice_rank of each transcript
+        first = trans[0]
+        ens_id = self.canonical.get((first.chrom, first.gene))
+        if ens_id is not None:
+            for tran in trans:
+                if tran.ens_id == ens_id:
+                    return tran
+
+        best, best_rank = None, None
+        for tran in trans:
+            rank = tran.choice_rank
+            if rank is None:
+                continue
+            # the last 001 or 201 wins, the first of the smallest other ids
+            if best is None or rank < best_rank or (rank[1] < 2 and rank == best_rank):
+                best, best_rank = tran, rank
+        return best
+
+    def write_canonical_table(self, out_fn):
+        # chrom, gene, ens_id of the representative transcript of each gene
+        with open(out_fn, 'w') as f:
+            for chrom in self.contigs:
+                genes_trans = OrderedDict()
+                for tran in self.fetch_chrom(chrom):
+                    genes_trans.setdefault(tran.gene, []).append(tran)
+                for gene_name, trans in genes_trans.items():
+                    tran = self.choose_tran_from_group(trans)
+                    if tran:
+                        f.write('\t'.join([chrom, gene_name, tran.ens_id]) + '\n')
+
     @staticmethod
     def choose_tran_from_group(trans,
                                default_biotypes=['protein_coding', 'lincRNA'],  # ,'miRNA'],
@@ -113,13 +528,51 @@ class Reader(object):
         return None
 
 
+def choice_rank(biotype, name, accepted_biotypes=('protein_coding', 'lincRNA')):
+    # sort key of choose_tran_from_group, the smallest wins, None never does
+    if biotype not in accepted_biotypes:
+        return None
+    name_id = name.split('-')[-1]
+    if 'protein_encoding' in biotype:
+        if name_id == '001':
+            return (0, 0, '')
+        if name_id == '201':
+            return (0, 1, '')
+        return (0, 2, name_id) if name_id < '999' else None
+    if name_id == '001':
+        return (1, 0, '')
+    if name_id == '201':
+        return (1, 1, '')
+    return (1, 2, name_id) if name_id < '999' else None
+
+
+def read_canonical_table(fn):
+    if not fn:
+        return {}
+    canonical = {}
+    with open(fn) as f:
+        for line in f:
+            chrom, gene_name, ens_id = line.rstrip('\n').split('\t')
+            canonical[(chrom, gene_name)] = ens_id
+    return canonical
+
+
 class Transcript(object):
 
-    def __init__(self, line):
+    _fields = 'source,version,col3,col4,start_condon,end_condon,protein_ens_id,col8,strand,name,ens_id,gtf_name,biotype,chrom,cytoband,left,right,exon_num,exon_lens,cds_info,exon_starts,gene'.split(',')
 
-        self._fields = 'source,version,col3,col4,start_condon,end_condon,protein_ens_id,col8,strand,name,ens_id,gtf_name,biotype,chrom,cytoband,left,right,exon_num,exon_lens,cds_info,exon_starts,gene'.split(',')
+    __slots__ = ('source', 'version', 'start_condon', 'end_condon',
+                 'protein_ens_id', 'col8', 'strand', 'name', 'ens_id',
+                 'gtf_name', 'biotype', 'chrom', 'cytoband', 'left', 'right',
+                 'exon_num', 'cds_info', 'gene',
+                 'extend', 'left_extend', 'right_extend', 'group',
+                 'choice_rank', '_exon_starts', '_exon_rights')
 
-        self._parse(line)
+    def __init__(self, line=None, **kwargs):
+        if line is not None:
+            self._parse(line)
+        else:
+            self._set(**kwargs)
 
     def _set(self, source=None, version=None, col3=None, col4=None,
              start_condon=None, end_condon=None, protein_ens_id=None, col8=None,
@@ -131,8 +584,8 @@ class Transcript(object):
              group=None):
         self.source = source
         self.version = version
-        self.start_condon = tuple(int(x) for x in start_condon.split(',') if x)
-        self.end_condon = tuple(int(x) for x in end_condon.split(',') if x)
+        self.start_condon = tuple(self._parse_ints(start_condon))
+        self.end_condon = tuple(self._parse_ints(end_condon))
         self.protein_ens_id = protein_ens_id
         self.col8 = col8
         self.strand = strand
@@ -145,16 +598,26 @@ class Transcript(object):
         self.left = int(left) + 1   # first exon start
         self.right = int(right)     # last exon end
         self.exon_num = exon_num
-        self.exon_lens = list(int(x) for x in exon_lens.split(',') if x)
         self.cds_info = cds_info
-        self.exon_starts = list(int(x) for x in exon_starts.split(',') if x)
         self.gene = gene
 
+        # exons in genomic order, (start, right] as 0-based start, 1-based end
+        starts = self._parse_ints(exon_starts)
+        self._exon_starts = array('l', starts)
+        self._exon_rights = array('l', map(add, starts, self._parse_ints(exon_lens)))
+
         self.extend = int(extend)
         self.left_extend = self.left - self.extend
         self.right_extend = self.right + self.extend
 
         self.group = group or []
+        self.choice_rank = choice_rank(biotype, name)
+
+    @staticmethod
+    def _parse_ints(x):  # comma separated string, or ints from TranscriptTable
+        if isinstance(x, str):
+            return list(int(v) for v in x.split(',') if v)
+        return list(x)
 
     def _parse(self, line):  # parse line to a record object
         args = dict(zip(self._fields, line.strip().split()))
@@ -170,17 +633,23 @@ class Transcript(object):
         left, right = region
         return left <= point and right >= point
 
+    def _number(self, i, n):  # genomic index to 1-based number in transcript order
+        if self.strand == '-':
+            return n - i
+        return i + 1
+
     def in_exons(self, point):
-        for i, exon in enumerate(self.exons):
-            if self._in_region(point, exon):
-                return i+1
-        return 0
+        i = bisect_left(self._exon_starts, point) - 1
+        if i < 0 or point > self._exon_rights[i]:
+            return 0
+        return self._number(i, len(self._exon_starts))
 
-    def in_introns(self, point):
-        for i, intron in enumerate(self.introns):
-            if self._in_region(point, intron):
-                return i+1
-        return 0
+    def in_introns(self, point):  # between exon i and i + 1
+        n = len(self._exon_starts)
+        i = bisect_left(self._exon_starts, point) - 1
+        if i < 0 or i >= n - 1 or point <= self._exon_rights[i]:
+            return 0
+        return self._number(i, n - 1)
 
     def in_utr5(self, point):
         return self._in_region(point, self.utr5)
@@ -188,23 +657,36 @@ class Transcript(object):
     def in_utr3(self, point):
         return self._in_region(point, self.utr3)
 
-    def in_promoter(self, point):
-        return self._in_region(point, self.promoter)
+    def _extends(self, extend=None):  # extend overrides the parse time one
+        if extend is None:
+            return self.left_extend, self.right_extend
+        return self.left - extend, self.right + extend
+
+    def _promoter(self, extend=None):
+        return self._get_promoter(extend)
+
+    def _terminator(self, extend=None):
+        return self._get_terminator(extend)
 
-    def in_terminator(self, point):
-        return self._in_region(point, self.terminator)
+    def in_promoter(self, point, extend=None):
+        return self._in_region(point, self._promoter(extend))
 
-    def in_upstream(self, point):  # 5' upstream
+    def in_terminator(self, point, extend=None):
+        return self._in_region(point, self._terminator(extend))
+
+    def in_upstream(self, point, extend=None):  # 5' upstream
+        left_extend, right_extend = self._extends(extend)
         if self.strand == '+':
-            return point < self.left_extend
+            return point < left_extend
         if self.strand == '-':
-            return point > self.right_extend
+            return point > right_extend
 
-    def in_downstream(self, point):  # 3' downstream
+    def in_downstream(self, point, extend=None):  # 3' downstream
+        left_extend, right_extend = self._extends(extend)
         if self.strand == '+':
-            return point > self.right_extend
+            return point > right_extend
         if self.strand == '-':
-            return point < self.left_extend
+            return point < left_extend
 
     def in_genetic(self, point):
         return self.in_exons(point) \
@@ -212,7 +694,7 @@ class Transcript(object):
                 or self.in_utr5(point) \
                 or self.in_utr3(point)
 
-    def mark_functional_region(self, point):
+    def mark_functional_region(self, point, extend=None):
         g = 'GENETIC'
         ig = 'INTERGENETIC'
         reg = 'REGULATION'
@@ -228,13 +710,13 @@ class Transcript(object):
         intron = self.in_introns(point)
         if intron:
             return g, 'i{}'.format(intron)
-        if self.in_promoter(point):
+        if self.in_promoter(point, extend):
             return reg, "promoter"
-        if self.in_terminator(point):
+        if self.in_terminator(point, extend):
             return reg, "terminator"
-        if self.in_upstream(point):
+        if self.in_upstream(point, extend):
             return ig, "upstream"
-        if self.in_downstream(point):
+        if self.in_downstream(point, extend):
             return ig, "downstream"
         return None, None
 
@@ -251,6 +733,124 @@ class Transcript(object):
             return min(abs(point-self.left), abs(point-self.right))
         return None
 
+    # --- vectorized versions, one transcript against many points --- #
+    @staticmethod
+    def _locate_many(points, lefts, rights):  # genomic index and hit mask
+        lefts, rights = np.asarray(lefts), np.asarray(rights)
+        if not len(lefts):
+            return np.zeros(len(points), dtype=np.int64), np.zeros(len(points), dtype=bool)
+        i = np.searchsorted(lefts, points, side='right') - 1
+        hit = (i >= 0) & (points <= rights[i])
+        return i, hit
+
+    def _search_many(self, points, lefts, rights):
+        i, hit = self._locate_many(points, lefts, rights)
+        res = np.zeros(len(points), dtype=np.int64)
+        if self.strand == '-':
+            res[hit] = len(lefts) - i[hit]
+        else:
+            res[hit] = i[hit] + 1
+        return res
+
+    @staticmethod
+    def _in_region_many(points, region):
+        if not region:
+            return np.zeros(len(points), dtype=bool)
+        left, right = region
+        return (left <= points) & (right >= points)
+
+    def _exon_bounds(self):  # 1-based inclusive lefts and rights, genomic order
+        return np.asarray(self._exon_starts) + 1, np.asarray(self._exon_rights)
+
+    def _intron_bounds(self):
+        lefts, rights = self._exon_bounds()
+        return rights[:-1] + 1, lefts[1:] - 1
+
+    def in_exons_many(self, points):
+        points = np.asarray(points, dtype=np.int64)
+        return self._search_many(points, *self._exon_bounds())
+
+    def in_introns_many(self, points):
+        points = np.asarray(points, dtype=np.int64)
+        return self._search_many(points, *self._intron_bounds())
+
+    def in_promoter_many(self, points, extend=None):
+        points = np.asarray(points, dtype=np.int64)
+        return self._in_region_many(points, self._promoter(extend))
+
+    def in_terminator_many(self, points, extend=None):
+        points = np.asarray(points, dtype=np.int64)
+        return self._in_region_many(points, self._terminator(extend))
+
+    def in_upstream_many(self, points, extend=None):
+        points = np.asarray(points, dtype=np.int64)
+        left_extend, right_extend = self._extends(extend)
+        if self.strand == '+':
+            return points < left_extend
+        if self.strand == '-':
+            return points > right_extend
+        return np.zeros(len(points), dtype=bool)
+
+    def in_downstream_many(self, points, extend=None):
+        points = np.asarray(points, dtype=np.int64)
+        left_extend, right_extend = self._extends(extend)
+        if self.strand == '+':
+            return points > right_extend
+        if self.strand == '-':
+            return points < left_extend
+        return np.zeros(len(points), dtype=bool)
+
+    def mark_functional_region_many(self, points, extend=None):
+        """Same as mark_functional_region, returns (classes, regions) arrays."""
+        points = np.asarray(points, dtype=np.int64)
+        g = 'GENETIC'
+        ig = 'INTERGENETIC'
+        reg = 'REGULATION'
+
+        exons = self.in_exons_many(points)
+        introns = self.in_introns_many(points)
+        marks = [
+            (g, 'utr5', self._in_region_many(points, self.utr5)),
+            (g, 'utr3', self._in_region_many(points, self.utr3)),
+            (g, 'e{}', exons > 0),
+            (g, 'i{}', introns > 0),
+            (reg, 'promoter', self.in_promoter_many(points, extend)),
+            (reg, 'terminator', self.in_terminator_many(points, extend)),
+            (ig, 'upstream', self.in_upstream_many(points, extend)),
+            (ig, 'downstream', self.in_downstream_many(points, extend)),
+        ]
+
+        classes = np.full(len(points), None, dtype=object)
+        regions = np.full(len(points), None, dtype=object)
+        todo = np.ones(len(points), dtype=bool)
+        for region_class, region, mask in marks:
+            mask &= todo
+            todo &= ~mask
+            classes[mask] = region_class
+            if region == 'e{}':
+                regions[mask] = ['e{}'.format(x) for x in exons[mask]]
+            elif region == 'i{}':
+                regions[mask] = ['i{}'.format(x) for x in introns[mask]]
+            else:
+                regions[mask] = region
+        return classes, regions
+
+    def mark_exon_distance_many(self, points):
+        points = np.asarray(points, dtype=np.int64)
+        res = np.minimum(np.abs(points - self.left), np.abs(points - self.right))
+
+        intron_lefts, intron_rights = self._intron_bounds()
+        i, in_intron = self._locate_many(points, intron_lefts, intron_rights)
+        if in_intron.any():
+            p = points[in_intron]
+            l = intron_lefts[i[in_intron]] - 1
+            r = intron_rights[i[in_intron]] + 1
+            res[in_intron] = np.minimum(p - l, r - p)
+
+        _, in_exon = self._locate_many(points, *self._exon_bounds())
+        res[in_exon] = 0
+        return res
+
     def get_exon(self, i):
         exons = self.exons
         if abs(i) > len(exons) or abs(i) < 1:
@@ -269,24 +869,49 @@ class Transcript(object):
         if i < 0:
             return introns[i]
 
+    # --- derived on access, only the exon bounds are stored --- #
     @property
-    def exons(self):  # start = start + 1, end = start + len, len is the number of base pairs
-        exon_starts = [start + 1 for start in self.exon_starts]
-        exon_ends = [start + l for start, l in zip(self.exon_starts, self.exon_lens)]
+    def exon_starts(self):
+        return list(self._exon_starts)
+
+    @property
+    def exon_lens(self):
+        return [right - start for start, right in zip(self._exon_starts, self._exon_rights)]
+
+    @property
+    def exons(self):  # start = start + 1, end = start + len, transcript order
+        exons = [(start + 1, right) for start, right in zip(self._exon_starts, self._exon_rights)]
         if self.strand == '-':
-            exon_starts = exon_starts[::-1]
-            exon_ends = exon_ends[::-1]
-        return list(zip(exon_starts, exon_ends))
+            return exons[::-1]
+        return exons
 
     @property
     def introns(self):
-        if self.strand == '+':
-            return [(left[-1]+1, right[0]-1) for left, right in zip(self.exons[:-1], self.exons[1:])]
+        if self.strand not in ('+', '-'):
+            return None
+        starts, rights = self._exon_starts, self._exon_rights
+        introns = [(right + 1, start) for right, start in zip(rights[:-1], starts[1:])]
         if self.strand == '-':
-            return [(left[-1]+1, right[0]-1) for right, left in zip(self.exons[:-1], self.exons[1:])]
+            return introns[::-1]
+        return introns
 
     @property
     def utr5(self):
+        return self._get_utr5()
+
+    @property
+    def utr3(self):
+        return self._get_utr3()
+
+    @property
+    def promoter(self):
+        return self._get_promoter()
+
+    @property
+    def terminator(self):
+        return self._get_terminator()
+
+    def _get_utr5(self):
         if not self.start_condon:
             return tuple()
         if self.strand == '+':
@@ -294,8 +919,7 @@ class Transcript(object):
         if self.strand == '-':
             return (self.start_condon[-1] + 1, self.right)
 
-    @property
-    def utr3(self):
+    def _get_utr3(self):
         if not self.end_condon:
             return tuple()
         if self.strand == '+':
@@ -303,19 +927,133 @@ class Transcript(object):
         if self.strand == '-':
             return (self.left, self.end_condon[0] - 1)
 
-    @property
-    def promoter(self):
+    def _get_promoter(self, extend=None):
+        left_extend, right_extend = self._extends(extend)
         if self.strand == '+':
-            return (self.left_extend, self.left - 1)
+            return (left_extend, self.left - 1)
         if self.strand == '-':
-            return (self.right + 1, self.right_extend)
+            return (self.right + 1, right_extend)
 
-    @property
-    def terminator(self):
+    def _get_terminator(self, extend=None):
+        left_extend, right_extend = self._extends(extend)
         if self.strand == '-':
-            return (self.left_extend, self.left - 1)
+            return (left_extend, self.left - 1)
         if self.strand == '+':
-            return (self.right + 1, self.right_extend)
+            return (self.right + 1, right_extend)
+
+
+
+# --- multi-process breakpoint annotation --- #
+annotation_fields = ['gene', 'transcript', 'biotype', 'group', 'region_class', 'region']
+
+_worker_reader = None
+
+
+def _init_worker(tran_fn, reader_kwargs):
+    # each worker holds its own Reader, and so its own tabix handle
+    global _worker_reader
+    _worker_reader = Reader(tran_fn, **reader_kwargs)
+
+
+def _format_annotations(annotations):
+    cols = [[] for _ in annotation_fields]
+    for tran, (region_class, region) in annotations:
+        values = [tran.gene, tran.name, tran.biotype, '|'.join(tran.group),
+                  region_class, region]
+        for col, value in zip(cols, values):
+            col.append(value or '.')
+    return [','.join(col) or '.' for col in cols]
+
+
+def _annotate_shard(shard):  # shard: [(order, chrom, pos), ...] sorted by pos
+    points = [(chrom, pos) for _, chrom, pos in shard]
+    annotated = _worker_reader.annotate_points(points)
+    return [(order, _format_annotations(annotations))
+            for (order, _, _), (_, _, annotations) in zip(shard, annotated)]
+
+
+def _make_shards(points, shard_size):
+    chroms = OrderedDict()
+    for order, (chrom, pos) in enumerate(points):
+        chroms.setdefault(chrom, []).append((order, chrom, pos))
+    for chrom_points in chroms.values():
+        chrom_points.sort(key=itemgetter(2))
+        for i in range(0, len(chrom_points), shard_size):
+            yield chrom_points[i:i+shard_size]
+
+
+def annotate_breakpoints(in_fn, out_fn, tran_fn, chrom_col=0, pos_col=1,
+                         sep='\t', processes=None, shard_size=50000,
+                         **reader_kwargs):
+    """Annotate a breakpoint table, sharded by chromosome over processes.
+
+    Appends annotation_fields to every row, multiple transcripts are comma
+    separated, and rows are written back in input order. Not streaming:
+    all input rows, points and annotations are held in memory until the
+    output is written, so memory grows with the size of the table.
+    """
+    headers, rows, points = [], [], []
+    with basic.safe_open(in_fn, 'rt') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#'):
+                headers.append(line)
+                continue
+            fields = line.split(sep)
+            rows.append(line)
+            points.append((fields[chrom_col], int(fields[pos_col])))
+
+    results = [None] * len(rows)
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(tran_fn, reader_kwargs))
+    try:
+        for shard_res in pool.imap_unordered(_annotate_shard, _make_shards(points, shard_size)):
+            for order, values in shard_res:
+                results[order] = values
+    except BaseException:
+        pool.terminate()  # do not wait for the remaining shards
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    with basic.safe_open(out_fn, 'wt') as f:
+        if headers:
+            headers[-1] = sep.join([headers[-1]] + annotation_fields)
+        for header in headers:
+            f.write(header + '\n')
+        for line, values in zip(rows, results):
+            f.write(sep.join([line] + values) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Annotate breakpoints with PSL transcripts.')
+    parser.add_argument('in_fn', help='breakpoint table')
+    parser.add_argument('out_fn', help='annotated breakpoint table')
+    parser.add_argument('tran_fn', help='PSL transcript table, tabix indexed 0-based')
+    parser.add_argument('--gene_list', default=None, help='gene list file or directory')
+    parser.add_argument('--chrom_col', type=int, default=0)
+    parser.add_argument('--pos_col', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--shard_size', type=int, default=50000)
+    parser.add_argument('--backend', choices=['tabix', 'index'], default='tabix',
+                        help='transcript lookup, tabix queries or an in-memory index')
+    parser.add_argument('--table_dir', default=None,
+                        help='transcript table compiled by compile_transcript_table, '
+                             'loaded by the index backend')
+    parser.add_argument('--canonical_fn', default=None,
+                        help='canonical transcript table from write_canonical_table')
+    args = parser.parse_args()
+
+    annotate_breakpoints(args.in_fn, args.out_fn, args.tran_fn,
+                         chrom_col=args.chrom_col, pos_col=args.pos_col,
+                         processes=args.processes, shard_size=args.shard_size,
+                         gene_list=args.gene_list, backend=args.backend,
+                         table_dir=args.table_dir, canonical_fn=args.canonical_fn)
+
+
+if __name__ == "__main__":
+    main()
 
 
 '''
@@ -0,0 +1,90 @@
+import gzip
+import random
+import threading
+import time
+
+import pytest
+
+from tenxtools.utils import bgzf
+
+
+def _text(n=20000, seed=1):
+    rng = random.Random(seed)
+    return ''.join('{}\t{}\txé\n'.format(i, rng.random()) for i in range(n))
+
+
+def _lines(fn, threads):
+    return list(bgzf.iter_lines(fn, threads=threads))
+
+
+def test_writer_round_trip(tmp_path):
+    fn = str(tmp_path / 'a.gz')
+    text = _text()
+    with bgzf.BgzfWriter(fn, 'w', threads=3) as f:
+        for i in range(0, len(text), 7777):
+            f.write(text[i:i+7777])
+    assert bgzf.is_bgzf(fn)
+    with open(fn, 'rb') as f:
+        assert f.read().endswith(bgzf.EOF_BLOCK)
+    with gzip.open(fn, 'rt') as f:
+        assert f.read() == text
+    assert _lines(fn, 0) == _lines(fn, 2) == text.splitlines(True)
+
+
+def test_writer_append_members(tmp_path):
+    fn = str(tmp_path / 'a.gz')
+    for i, mode in enumerate('wa'):
+        with bgzf.BgzfWriter(fn, mode, threads=2) as f:
+            f.write(b'line%d\n' % i)
+    assert _lines(fn, 2) == ['line0\n', 'line1\n']
+
+
+def test_multi_member_gzip(tmp_path):
+    fn = str(tmp_path / 'a.gz')
+    text = _text(30000)
+    for i, mode in enumerate(['wt', 'at', 'at']):
+        with gzip.open(fn, mode) as f:
+            f.write(text[i*10000:(i+1)*10000] if i < 2 else text[20000:])
+    assert not bgzf.is_bgzf(fn)
+    assert _lines(fn, 2) == _lines(fn, 0) == text.splitlines(True)
+
+
+@pytest.mark.parametrize('tail', ['\r\n', '\r', '', 'last\x0cfield\u2028z'])
+def test_newlines_match_text_mode(tmp_path, tail):
+    text = 'a\r\nb\rc\nd\x0ce\r\n' * 5000 + 'end' + tail
+    for writer in (gzip.open, lambda fn, mode: bgzf.BgzfWriter(fn, mode, threads=2)):
+        fn = str(tmp_path / 'a.gz')
+        with writer(fn, 'wb') as f:
+            f.write(text.encode())
+        assert _lines(fn, 2) == _lines(fn, 0)
+
+
+@pytest.mark.parametrize('bgzip', [True, False])
+def test_early_close_stops_threads(tmp_path, bgzip):
+    fn = str(tmp_path / 'a.gz')
+    opener = (lambda fn: bgzf.BgzfWriter(fn, 'w', threads=2)) if bgzip else \
+        (lambda fn: gzip.open(fn, 'wt'))
+    with opener(fn) as f:
+        f.write(_text(200000))
+    before = threading.active_count()
+    lines = bgzf.iter_lines(fn, threads=2, read_ahead=2)
+    assert next(lines).startswith('0\t')
+    lines.close()
+    for _ in range(50):
+        if threading.active_count() <= before:
+            break
+        time.sleep(0.05)
+    assert threading.active_count() <= before
+
+
+def test_appends_keep_one_eof_block(tmp_path):
+    fn = str(tmp_path / 'a.gz')
+    before = threading.active_count()
+    for i, mode in enumerate('waaa'):
+        with bgzf.BgzfWriter(fn, mode, threads=2) as f:
+            f.write('line{}\n'.format(i))
+            assert threading.active_count() == before  # short, no threads
+    with open(fn, 'rb') as f:
+        data = f.read()
+    assert data.count(bgzf.EOF_BLOCK) == 1 and data.endswith(bgzf.EOF_BLOCK)
+    assert _lines(fn, 2) == ['line{}\n'.format(i) for i in range(4)]
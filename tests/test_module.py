@@ -0,0 +1,138 @@
+import json
+import time
+from functools import partial
+
+from tenxtools.utils import module, myio
+
+
+def add1(meta, x):
+    return meta, x + 1
+
+
+def mul10(meta, x):
+    return meta, x * 10
+
+
+def drop_odd(chunk):
+    return [(meta, x) for meta, x in chunk if x % 2 == 0]
+
+
+def fail_on_3(meta, x):
+    if x == 3:
+        raise KeyError(x)
+    return meta, x
+
+
+def _values(stage):
+    return [x for _, x in stage]
+
+
+def test_parallel_map_keeps_order():
+    src = [('m', x) for x in range(100)]
+    for processes in (0, 2):
+        stage = module.ParallelMapModule(src, add1, processes=processes, chunk_size=7)
+        assert _values(stage) == list(range(1, 101))
+
+
+def test_parallel_map_chained_in_process():
+    src = [('m', x) for x in range(1, 6)]
+    stage = module.ParallelMapModule(
+        module.ParallelMapModule(src, add1, processes=0), mul10, processes=0)
+    assert _values(stage) == [20, 30, 40, 50, 60]
+
+
+def test_parallel_map_chained_mixed():
+    src = [('m', x) for x in range(1, 6)]
+    stage = module.ParallelMapModule(
+        module.ParallelMapModule(src, add1, processes=2, chunk_size=2),
+        drop_odd, per_chunk=True, processes=0, chunk_size=3)
+    assert _values(stage) == [2, 4, 6]
+
+
+def test_parallel_map_error_has_record():
+    src = [('m', x) for x in range(5)]
+    for processes in (0, 2):
+        try:
+            list(module.ParallelMapModule(src, fail_on_3, processes=processes))
+        except module.ParallelMapError as e:
+            assert e.record == repr(('m', 3))
+            assert 'KeyError' in e.tb
+        else:
+            assert False
+
+
+def test_parallel_map_bounds_upstream_reads():
+    pulled = []
+
+    def src():
+        for x in range(200000):
+            pulled.append(x)
+            yield 'm', x
+
+    stage = iter(module.ParallelMapModule(src(), add1, processes=2, chunk_size=10))
+    assert next(stage) == ('m', 1)
+    time.sleep(1)
+    # 2 chunks per process in flight, plus the one being submitted
+    assert len(pulled) <= 10 * (2 * 2 + 1)
+    stage.close()
+
+
+class _Crash(module.Module):
+
+    def __init__(self, n, crash_at=None, **kwargs):
+        module.Module.__init__(self, **kwargs)
+        self.n = n
+        self.crash_at = crash_at
+
+    def __iter__(self):
+        for i in range(self.n):
+            if i == self.crash_at:
+                raise RuntimeError('crash')
+            yield 'm{}'.format(i % 3), myio.Record(args={'i': i})
+
+
+def test_resume_passes_all_records_downstream(tmp_path):
+    class R(myio.Record):
+        fields = ['i']
+
+    kwargs = dict(write=True, writer_cls=partial(myio.Writer, record_cls=R),
+                  write_mode='split', out_dir=str(tmp_path), prefix='p', suffix='tsv',
+                  chunk_size=10, checkpoint_fn=str(tmp_path / 'ck.json'),
+                  checkpoint_every=100)
+    try:
+        list(_Crash(1000, crash_at=750, **kwargs).evaluate('stream'))
+    except RuntimeError:
+        pass
+    assert (tmp_path / 'ck.json').exists()
+    out = [str(r) for _, r in _Crash(1000, **kwargs).evaluate('tee')]
+    assert out == [str(i) for i in range(1000)]
+    assert not (tmp_path / 'ck.json').exists()
+    lines = (tmp_path / 'p.m1.tsv').read_text().splitlines()
+    assert lines[1:] == [str(i) for i in range(1, 1000, 3)]
+
+
+class _Passthrough(module.Module):
+
+    def __iter__(self):
+        for _, record in self.in_iter:
+            yield 'm{}'.format(int(record.i) % 2), record
+
+
+def test_profile_stages_and_bytes(tmp_path):
+    class R(myio.Record):
+        fields = ['i', 'x']
+
+    in_fn = tmp_path / 'in.tsv'
+    in_fn.write_text(''.join('{}\tx{}\n'.format(i, i) for i in range(500)))
+    stage = _Passthrough(
+        in_fn=str(in_fn), reader_cls=partial(myio.Reader, record_cls=R, sep='\t'),
+        write=True, writer_cls=partial(myio.Writer, record_cls=R), write_mode='split',
+        out_dir=str(tmp_path), prefix='p', suffix='tsv.gz', chunk_size=50, profile=True)
+    stage.evaluate('write')
+    with open(str(tmp_path / 'p.tsv.gz.profile.json')) as f:
+        profile = json.load(f)
+    assert profile['records'] == 500
+    assert profile['stages']['construct']['calls'] == 500
+    assert set(profile['stages']) == {'iterate', 'construct', 'write_line', 'write_chunk'}
+    assert profile['bytes'] == dict(
+        (meta, (tmp_path / 'p.{}.tsv.gz'.format(meta)).stat().st_size) for meta in ('m0', 'm1'))
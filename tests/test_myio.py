@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+pysam = pytest.importorskip('pysam')
+
+from tenxtools.utils import bgzf, myio
+
+
+class Bed(myio.Record):
+    fields = ['chrom', 'start', 'end', 'name']
+
+
+@pytest.fixture(scope='module')
+def bed_fn(tmp_path_factory):
+    fn = str(tmp_path_factory.mktemp('bed') / 'x.bed')
+    rng = random.Random(1)
+    with open(fn, 'w') as f:
+        for chrom in ['chr1', 'chr2']:
+            for start in sorted(rng.randint(1, 100000) for _ in range(300)):
+                end = start + rng.randint(0, 2000)
+                f.write('{}\t{}\t{}\tr{}\n'.format(chrom, start, end, start))
+    return pysam.tabix_index(fn, seq_col=0, start_col=1, end_col=2)
+
+
+def _fetch_each(reader, regions):
+    res = []
+    for region in regions:
+        try:
+            records = list(reader.fetch(*region))
+        except ValueError:  # chrom not in index
+            records = []
+        res.extend((region, str(record)) for _, record in records)
+    return res
+
+
+def test_fetch_many_matches_fetch(bed_fn):
+    reader = myio.Reader(in_fn=bed_fn, record_cls=Bed, sep='\t')
+    rng = random.Random(2)
+    regions = []
+    for _ in range(200):
+        chrom = rng.choice(['chr1', 'chr2'])
+        start = rng.randint(0, 100000)
+        regions.append((chrom, start, start + rng.choice([0, 1, 50, 1000, 5000])))
+    chrom, start, end = regions[0]
+    regions += [
+        (chrom, start, end),                  # duplicate
+        (chrom, end, end + 100),              # adjacent
+        (chrom, start + 10, start + 10),      # zero width inside a merged block
+        ('chr1', 5000, 4000),                 # start > end
+        ('chrX', 0, 100000),                  # unknown chrom
+    ]
+    many = [(region, str(record)) for region, record in reader.fetch_many(regions)]
+    assert many == _fetch_each(reader, regions)
+
+
+def test_threaded_writer_without_session(tmp_path):
+    fn = str(tmp_path / 'x.bed.gz')
+    writer = myio.Writer(fn, record_cls=Bed, threads=2)
+    writer.write_fields()
+    for i in range(5):
+        writer.write_chunk([Bed(args={'chrom': 'chr1', 'start': i, 'end': i + 1, 'name': 'r'})])
+    with open(fn, 'rb') as f:
+        data = f.read()
+    assert bgzf.is_bgzf(fn) and data.count(bgzf.EOF_BLOCK) == 1
+    assert list(bgzf.iter_lines(fn)) == ['#chrom\tstart\tend\tname\n'] + [
+        'chr1\t{}\t{}\tr\n'.format(i, i + 1) for i in range(5)]
@@ -0,0 +1,142 @@
+import random
+import threading
+
+import pytest
+
+pysam = pytest.importorskip('pysam')
+
+from tenxtools.utils import psl_tran
+
+
+def _rows(rng):
+    rows = []
+    for chrom in ['chr1', 'chr2']:
+        pos = 1000
+        for g in range(60):
+            gene = 'G{}_{}'.format(chrom, g)
+            gstart = pos + rng.randint(0, 30000)
+            for t in range(rng.randint(1, 4)):
+                n = rng.randint(1, 5)
+                s = gstart + rng.randint(0, 2000)
+                starts, lens = [], []
+                for _ in range(n):
+                    length = rng.randint(50, 500)
+                    starts.append(s)
+                    lens.append(length)
+                    s += length + rng.randint(0, 3000)
+                left, right = starts[0], starts[-1] + lens[-1]
+                name = '{}-{:03d}'.format(gene, rng.choice([1, 2, 201]))
+                rows.append([
+                    'ensembl', 'NA', '0', '0', ',', ',', 'ENSP1', '0',
+                    rng.choice('+-'), name, 'ENST{}{}{}'.format(chrom, g, t),
+                    name, 'protein_coding', chrom, 'p1', str(left), str(right),
+                    str(n), ','.join(map(str, lens)) + ',', 'x',
+                    ','.join(map(str, starts)) + ',', gene])
+            pos = gstart + rng.randint(-5000, 20000)
+    rows.sort(key=lambda r: (r[13], int(r[15])))
+    return rows
+
+
+@pytest.fixture(scope='module')
+def tran_fn(tmp_path_factory):
+    fn = str(tmp_path_factory.mktemp('psl') / 'trans.psl')
+    with open(fn, 'w') as f:
+        for row in _rows(random.Random(1)):
+            f.write('\t'.join(row) + '\n')
+    # the left column is 0-based
+    return pysam.tabix_index(fn, seq_col=13, start_col=15, end_col=16, zerobased=True)
+
+
+def test_index_matches_tabix(tran_fn):
+    tabix = psl_tran.Reader(tran_fn)
+    index = psl_tran.Reader(tran_fn, backend='index')
+    rng = random.Random(2)
+    for _ in range(2000):
+        chrom = rng.choice(['chr1', 'chr2', 'chr3'])
+        start = rng.randint(0, 1500000)
+        end = start + rng.choice([0, 1, 10, 1000, 50000])
+        expected = [str(t) for t in tabix.fetch(chrom, start, end)]
+        assert [str(t) for t in index.fetch(chrom, start, end)] == expected
+        assert [str(t) for t in index.fetch(chrom, end, start)] == expected
+
+
+def test_boundaries(tran_fn):
+    readers = [psl_tran.Reader(tran_fn, backend=backend) for backend in ('tabix', 'index')]
+    trans = list(readers[0].fetch_chrom('chr1'))[::7]
+    for tran in trans:
+        left = tran.left - 1  # 0-based
+        for pos, hit in [(left - 1, False), (left, True),
+                         (tran.right - 1, True), (tran.right, False)]:
+            for reader in readers:
+                ids = [t.ens_id for t in reader.fetch('chr1', pos, pos + 1)]
+                assert (tran.ens_id in ids) == hit, (reader.index, pos)
+
+    points = sorted(set(('chr1', p) for t in trans
+                        for p in (t.left - 2, t.left - 1, t.right - 1, t.right)))
+    for reader in readers:
+        for chrom, pos, annotations in reader.annotate_points(points):
+            expected = [str(t) for t in reader.fetch_genes_tran_by_point(chrom, pos)]
+            assert [str(t) for t, _ in annotations] == expected
+
+
+def test_zero_width_fetch_is_empty(tran_fn):
+    for backend in ('tabix', 'index'):
+        reader = psl_tran.Reader(tran_fn, backend=backend)
+        tran = next(reader.fetch_chrom('chr1'))
+        pos = (tran.left + tran.right) // 2
+        assert list(reader.fetch('chr1', pos, pos)) == []
+
+
+def _fields(tran):
+    return (str(tran), tran.ens_id, tran.exon_starts, tran.exon_lens,
+            tran.start_condon, tran.end_condon, tran.cds_info)
+
+
+def test_table_index_matches_tabix(tran_fn, tmp_path):
+    table_dir = psl_tran.compile_transcript_table(tran_fn, str(tmp_path / 'table'))
+    tabix = psl_tran.Reader(tran_fn)
+    index = psl_tran.Reader(tran_fn, backend='index', table_dir=table_dir)
+    rng = random.Random(3)
+    for _ in range(500):
+        chrom = rng.choice(['chr1', 'chr2', 'chr3'])
+        start = rng.randint(0, 1500000)
+        end = start + rng.choice([1, 1000, 50000])
+        expected = [_fields(t) for t in tabix.fetch(chrom, start, end)]
+        hits = list(index.fetch(chrom, start, end))
+        assert [_fields(t) for t in hits] == expected
+        # built once per row
+        assert all(a is b for a, b in zip(hits, index.fetch(chrom, start, end)))
+
+
+def test_table_dir_needs_index_backend(tran_fn, tmp_path):
+    with pytest.raises(ValueError):
+        psl_tran.Reader(tran_fn, table_dir=str(tmp_path))
+
+
+def test_pool_close_covers_all_threads(tran_fn):
+    pool = psl_tran.TabixPool()
+    barrier = threading.Barrier(4)
+
+    def fetch():
+        pool.get(tran_fn)
+        barrier.wait()  # all three alive, each with its own handle
+        barrier.wait()
+
+    threads = [threading.Thread(target=fetch) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    assert pool.stats()['open'] == 3
+    pool.close()
+    assert pool.stats()['open'] == 0
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+
+    # a new thread closes the handles of finished ones
+    for _ in range(2):
+        thread = threading.Thread(target=pool.get, args=(tran_fn,))
+        thread.start()
+        thread.join()
+    assert pool.stats()['open'] == 1
+    pool.close()